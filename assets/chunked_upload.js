@@ -0,0 +1,69 @@
+// Stream large files to the server in chunks instead of sending them through
+// dcc.Upload as a single base64 string. On completion the dataset ID returned
+// by the server is written to the 'dataset-id' store, which triggers the same
+// callbacks as a regular upload.
+(function () {
+    var CHUNK_SIZE = 4 * 1024 * 1024;
+
+    function urlBase() {
+        var config = document.getElementById('_dash-config');
+        return config ? JSON.parse(config.textContent).requests_pathname_prefix : '/';
+    }
+
+    function setProgress(text) {
+        if (window.dash_clientside && window.dash_clientside.set_props) {
+            window.dash_clientside.set_props('upload-progress', {children: text});
+        }
+    }
+
+    function uploadId() {
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+
+    async function uploadFile(file) {
+        var endpoint = urlBase() + '_upload/' + uploadId();
+        for (var offset = 0; offset < file.size; offset += CHUNK_SIZE) {
+            var response = await fetch(endpoint, {
+                method: 'POST',
+                headers: {'X-Upload-Offset': String(offset)},
+                body: file.slice(offset, offset + CHUNK_SIZE)
+            });
+            if (!response.ok) {
+                throw new Error((await response.json()).error);
+            }
+            setProgress('Uploading ' + file.name + ': ' +
+                        Math.round(100 * Math.min(offset + CHUNK_SIZE, file.size) / file.size) + '%');
+        }
+        var finished = await fetch(endpoint + '/finish', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name})
+        });
+        if (!finished.ok) {
+            throw new Error((await finished.json()).error);
+        }
+        return (await finished.json()).dataset_id;
+    }
+
+    // The 'large-upload' button opens a file picker; the chosen file is streamed
+    document.addEventListener('click', function (event) {
+        if (!event.target || event.target.id !== 'large-upload') {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.accept = '.csv,.tsv,.txt,.tab,.gz,.xls,.xlsx,.parquet,.pq,.feather,.arrow';
+        input.addEventListener('change', function () {
+            if (!input.files.length) {
+                return;
+            }
+            uploadFile(input.files[0]).then(function (datasetId) {
+                setProgress('');
+                window.dash_clientside.set_props('dataset-id', {data: datasetId});
+            }).catch(function (error) {
+                setProgress('Upload failed: ' + error.message);
+            });
+        });
+        input.click();
+    });
+})();
@@ -0,0 +1,70 @@
+// Clientside callbacks for controls that only change how figures look. They
+// run in the browser, so restyling never waits behind renders on the server;
+// the server is only asked for a new figure when the data or labels change.
+(function () {
+    // Value of a daq.ColorPicker, like utils.normalize_color
+    function hexColor(color) {
+        return color && color.hex ? color.hex : color;
+    }
+
+    // Same as utils.density_colorscale
+    function densityColorscale(color) {
+        if (typeof color === 'string' && /^#[0-9a-fA-F]{6}$/.test(color)) {
+            var rgb = [1, 3, 5].map(function (i) { return parseInt(color.slice(i, i + 2), 16); }).join(',');
+            return [[0, 'rgba(' + rgb + ',0.25)'], [1, 'rgba(' + rgb + ',1)']];
+        }
+        return [[0, color], [1, color]];
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        annofig: {
+            // CSS size of both figures
+            figureSize: function (width, height) {
+                var style = {
+                    width: (width ? width : 600) + 'px',
+                    height: (height ? height : 600) + 'px'
+                };
+                return [style, style];
+            },
+
+            // Restyle the interactive figure in place. The first trace holds the
+            // background points (a heatmap when they are binned) and the second
+            // one the highlighted points, as built by generate_interactive_figure.
+            styleInteractiveFigure: function (pointSize, pointColor, theme, annotationColor,
+                                              annotationFontSize, annotationFontColor,
+                                              figure, templates) {
+                if (!figure || !figure.data || figure.data.length < 2) {
+                    return window.dash_clientside.no_update;
+                }
+                var color = hexColor(pointColor);
+                var data = figure.data.slice();
+                var background = Object.assign({}, data[0]);
+                if (background.type === 'heatmap') {
+                    background.colorscale = densityColorscale(color);
+                } else {
+                    background.marker = Object.assign({}, background.marker,
+                                                      {size: pointSize, color: color});
+                }
+                data[0] = background;
+                data[1] = Object.assign({}, data[1], {
+                    marker: Object.assign({}, data[1].marker,
+                                          {size: pointSize, color: hexColor(annotationColor)}),
+                    textfont: {size: annotationFontSize * 2, color: hexColor(annotationFontColor)}
+                });
+                var layout = Object.assign({}, figure.layout,
+                                           {template: templates[theme === 'light' ? 'light' : 'dark']});
+                return Object.assign({}, figure, {data: data, layout: layout});
+            },
+
+            // Forward only the region of a box or lasso selection: the selected
+            // points themselves can be millions, and are looked up in the point
+            // index on the server instead
+            selectionRegion: function (selected) {
+                if (!selected || !(selected.range || selected.lassoPoints)) {
+                    return window.dash_clientside.no_update;
+                }
+                return {range: selected.range || null, lassoPoints: selected.lassoPoints || null};
+            }
+        }
+    });
+})();
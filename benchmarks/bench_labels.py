@@ -0,0 +1,112 @@
+"""Check and time the label placement of the static figure.
+
+Usage: python benchmarks/bench_labels.py [--labels 10 100 400] [--cornered 20]
+           [--repeat 3]
+
+Two layouts must place every label at a free spot, or the script exits
+with status 1: anchors spread on a grid of an otherwise empty canvas, each
+with room for its label, and a few anchors packed in a corner of an empty
+canvas, whose labels only fit further away with leader lines (like the top
+genes of a volcano plot). It then times the placement of crowded labels on
+the top of a synthetic volcano plot, where labels compete for space, and
+reports how many were placed at a free spot, left overlapping others at
+their default spot, or dropped by the budget.
+"""
+import argparse
+import os
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from labels import place_labels  # noqa: E402
+
+
+def separated_anchors(count, seed=0):
+    """Return a figure with ``count`` labels on jittered grid anchors, and their texts."""
+    side = int(np.ceil(np.sqrt(count)))
+    fig, ax = plt.subplots(figsize=(side * 1.2, side * 0.6), dpi=100)
+    ax.set_xlim(0, side)
+    ax.set_ylim(0, side)
+    rng = np.random.default_rng(seed)
+    cells = np.arange(count)
+    x = cells % side + 0.5 + rng.uniform(-0.2, 0.2, count)
+    y = cells // side + 0.5 + rng.uniform(-0.2, 0.2, count)
+    texts = [ax.text(xi, yi, f'GENE{i}', fontsize=8) for i, (xi, yi) in enumerate(zip(x, y))]
+    ax.scatter(x, y, s=4)
+    return fig, ax, texts, x, y
+
+
+def cornered_anchors(count, seed=0):
+    """Return a figure with ``count`` labels on anchors packed in its top left corner."""
+    rng = np.random.default_rng(seed)
+    fig, ax = plt.subplots(figsize=(6, 6), dpi=100)
+    ax.set_xlim(0, 100)
+    ax.set_ylim(0, 100)
+    x = rng.uniform(1, 6, count)
+    y = rng.uniform(94, 99, count)
+    texts = [ax.text(xi, yi, f'GENE{i}', fontsize=8) for i, (xi, yi) in enumerate(zip(x, y))]
+    ax.scatter(x, y, s=4)
+    return fig, ax, texts, x, y
+
+
+def crowded_anchors(count, seed=0):
+    """Return a figure with ``count`` labels on the top of a volcano-shaped cloud."""
+    rng = np.random.default_rng(seed)
+    fig, ax = plt.subplots(figsize=(6, 6), dpi=100)
+    fold_change = rng.normal(0, 1.5, count * 50)
+    score = np.abs(fold_change) * rng.uniform(0, 10, count * 50)
+    top = np.argsort(-score)[:count]
+    ax.scatter(fold_change, score, s=2)
+    texts = [ax.text(fold_change[k], score[k], f'GENE{k}', fontsize=8) for k in top]
+    return fig, ax, texts, fold_change[top], score[top]
+
+
+def run(make, count, repeat):
+    timings = []
+    for _ in range(repeat):
+        fig, ax, texts, x, y = make(count)
+        start = time.perf_counter()
+        report = place_labels(ax, texts, x, y)
+        timings.append(time.perf_counter() - start)
+        plt.close(fig)
+    return min(timings), report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--labels', nargs='+', type=int, default=[10, 100, 400])
+    parser.add_argument('--cornered', type=int, default=20,
+                        help='number of labels packed in a corner')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for count in args.labels:
+        seconds, report = run(separated_anchors, count, args.repeat)
+        ok = report.placed == count
+        failed |= not ok
+        print(f"separated {count:6} labels {seconds * 1000:9.1f} ms  "
+              f"placed={report.placed} overlapping={report.overlapping} "
+              f"dropped={report.dropped}  {'ok' if ok else 'FAILED'}")
+    seconds, report = run(cornered_anchors, args.cornered, args.repeat)
+    ok = report.placed == args.cornered
+    failed |= not ok
+    print(f"cornered  {args.cornered:6} labels {seconds * 1000:9.1f} ms  "
+          f"placed={report.placed} overlapping={report.overlapping} "
+          f"dropped={report.dropped}  {'ok' if ok else 'FAILED'}")
+    for count in args.labels:
+        seconds, report = run(crowded_anchors, count, args.repeat)
+        print(f"crowded   {count:6} labels {seconds * 1000:9.1f} ms  "
+              f"placed={report.placed} overlapping={report.overlapping} "
+              f"dropped={report.dropped}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
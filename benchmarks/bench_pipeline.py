@@ -0,0 +1,198 @@
+"""Time every stage of the render pipeline on synthetic omics tables.
+
+Usage: python benchmarks/bench_pipeline.py [--kinds volcano ma scatter]
+           [--sizes 1e3 1e4 1e5 1e6] [--labels 20] [--repeat 3]
+           [--output results.json] [--compare baseline.json] [--no-memory]
+
+For every table kind and size the following stages are measured separately:
+
+- ``parse``: reading the table from a CSV file (``ingest.read_table``)
+- ``annotate``: selecting the labels (``get_annotate_labels``)
+- ``interactive``: building the Plotly figure (``generate_interactive_figure``)
+- ``serialize``: serializing it to JSON, as sent to the browser
+- ``static``: rendering the static PNG (``generate_static_figure``)
+- ``static_svg``: rendering it as SVG, whose size shows whether the
+  background points were rasterized
+- ``labels``: the label placement part of ``static``
+
+Each stage is timed as the best of ``--repeat`` runs, then run once more
+under tracemalloc for its peak Python memory. Results are written as JSON,
+with the git commit and library versions, so that runs on different commits
+can be compared with ``--compare``. Sizes up to 1e7 rows are supported but
+take minutes (and several GB of memory) for the static stage.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, SRC)
+from ingest import read_table  # noqa: E402
+from utils import (generate_interactive_figure, generate_static_figure,  # noqa: E402
+                   get_annotate_labels)
+
+KINDS = ('volcano', 'ma', 'scatter')
+
+
+def make_table(kind, rows, seed=0):
+    """Return a synthetic table and the figure parameters for plotting it.
+
+    ``volcano``: log2 fold change against adjusted p-value (log, reversed),
+    ``ma``: mean expression (log) against log2 fold change, ``scatter``: two
+    correlated scores. Labels are ranked by adjusted p-value or score.
+    """
+    rng = np.random.default_rng(seed)
+    genes = pd.Series([f'GENE{i}' for i in range(rows)])
+    log2fc = rng.normal(0, 1.5, rows)
+    # Differentially expressed genes have both large fold changes and small p-values
+    pvalues = np.clip(rng.uniform(0, 1, rows) ** (1 + 4 * np.abs(log2fc)), 1e-300, 1)
+    if kind == 'volcano':
+        df = pd.DataFrame({'gene': genes, 'log2FoldChange': log2fc,
+                           'pvalue': pvalues, 'padj': np.minimum(pvalues * 10, 1)})
+        params = dict(x_col='log2FoldChange', y_col='padj', y_log=True, y_revert=True,
+                      annotate_col='padj')
+    elif kind == 'ma':
+        df = pd.DataFrame({'gene': genes, 'baseMean': rng.lognormal(5, 2, rows),
+                           'log2FoldChange': log2fc, 'padj': np.minimum(pvalues * 10, 1)})
+        params = dict(x_col='baseMean', y_col='log2FoldChange', x_log=True,
+                      annotate_col='padj')
+    elif kind == 'scatter':
+        x = rng.normal(0, 1, rows)
+        df = pd.DataFrame({'gene': genes, 'score_a': x,
+                           'score_b': 0.7 * x + rng.normal(0, 0.7, rows)})
+        df['distance'] = np.hypot(df['score_a'], df['score_b'])
+        params = dict(x_col='score_a', y_col='score_b', annotate_col='distance',
+                      annotate_revert=True)
+    else:
+        raise ValueError(f"Unknown table kind: {kind}")
+    return df, dict(params, label_col='gene')
+
+
+def measure(func, repeat, memory):
+    """Return (best seconds, peak traced bytes or None, last result) of ``func()``."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(timings), peak, result
+
+
+def run_case(kind, rows, labels, repeat, memory, workdir):
+    df, params = make_table(kind, rows)
+    path = os.path.join(workdir, f'{kind}_{rows}.csv')
+    df.to_csv(path, index=False)
+    # Each column once, like the app requests them (padj is both y and annotate column)
+    columns = list(dict.fromkeys(params[name]
+                                 for name in ('x_col', 'y_col', 'label_col', 'annotate_col')))
+    results = []
+
+    def record(stage, seconds, peak, **extra):
+        results.append(dict(kind=kind, rows=rows, labels=labels, stage=stage,
+                            seconds=seconds, peak_bytes=peak, **extra))
+        print(f"{kind:8} {rows:>9} {stage:12} {seconds * 1000:10.1f} ms"
+              + (f" {peak / 1024 ** 2:9.1f} MB" if peak is not None else "")
+              + ''.join(f"  {key}={value}" for key, value in extra.items()))
+
+    seconds, peak, df = measure(lambda: read_table(path, path, columns), repeat, memory)
+    record('parse', seconds, peak, file_bytes=os.path.getsize(path))
+
+    annotate = dict(top_n=labels, annotate_col=params['annotate_col'],
+                    label_col=params['label_col'],
+                    annotate_revert=params.get('annotate_revert', False))
+    seconds, peak, sel_labels = measure(
+        lambda: get_annotate_labels(df, annotate_cutoff=None, manual_genes='', **annotate),
+        repeat, memory)
+    record('annotate', seconds, peak, selected=len(sel_labels))
+
+    figure_params = dict(params, top_n=labels)
+    seconds, peak, figure = measure(
+        lambda: generate_interactive_figure(df, **figure_params), repeat, memory)
+    record('interactive', seconds, peak, background=figure.data[0].type)
+    seconds, peak, figure_json = measure(figure.to_json, repeat, memory)
+    record('serialize', seconds, peak, json_bytes=len(figure_json))
+
+    seconds, peak, (png_bytes, report) = measure(
+        lambda: generate_static_figure(df, return_report=True, **figure_params),
+        repeat, memory)
+    record('static', seconds, peak, png_bytes=len(png_bytes))
+    seconds, peak, svg_bytes = measure(
+        lambda: generate_static_figure(df, fmt='svg', **figure_params), repeat, memory)
+    record('static_svg', seconds, peak, svg_bytes=len(svg_bytes))
+    if report is not None:
+        record('labels', report.seconds, None, placed=report.placed,
+               overlapping=report.overlapping, dropped=report.dropped,
+               iterations=report.iterations)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import matplotlib
+    import plotly
+    return {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'plotly': plotly.__version__, 'matplotlib': matplotlib.__version__}
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['kind'], r['rows'], r['labels'], r['stage']): r
+                    for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path} (ratio > 1 is slower):")
+    for result in results:
+        old = baseline.get((result['kind'], result['rows'], result['labels'], result['stage']))
+        if old and old['seconds']:
+            print(f"{result['kind']:8} {result['rows']:>9} {result['stage']:12} "
+                  f"{result['seconds'] / old['seconds']:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6])
+    parser.add_argument('--labels', type=int, default=20,
+                        help='number of top ranked points to label')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_pipeline.json')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc runs')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind in args.kinds:
+            for rows in args.sizes:
+                results += run_case(kind, int(rows), args.labels, args.repeat,
+                                    args.memory, workdir)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare the vectorized preprocessing stage with the previous row-wise code.
+
+Usage: python benchmarks/bench_preprocess.py [--rows 1000000] [--top-n 50]
+
+The "legacy" functions below reproduce the code both figure generators used
+before preprocessing was shared (``Series.apply`` clamping, a full sort for
+the top N, ``set`` de-duplication and ``iterrows`` for the labels).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from utils import get_annotate_labels, prepare_plot_data  # noqa: E402
+
+
+def make_table(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    pvalues = rng.uniform(0, 1, rows) ** 4
+    pvalues[rng.integers(0, rows, rows // 1000)] = 0  # exercises the log clamp
+    return pd.DataFrame({
+        'gene': [f'GENE{i}' for i in range(rows)],
+        'log2FoldChange': rng.normal(0, 2, rows),
+        'padj': pvalues,
+    })
+
+
+def legacy(df, x_col, y_col, label_col, annotate_col, top_n, cutoff):
+    df = df.copy()  # the legacy code mutated its input
+    min_positive_value = df[df[y_col] > 0][y_col].min()
+    df[y_col] = df[y_col].apply(lambda x: min_positive_value if x <= 0 else x)
+    sel_labels = []
+    sorted_df = df.sort_values(by=annotate_col, ascending=True)
+    sel_labels += sorted_df[label_col].head(top_n).tolist()
+    sel_labels += df[df[annotate_col] < cutoff][label_col].tolist()
+    sel_labels = list(set(sel_labels))
+    highlighted_df = df[df[label_col].isin(sel_labels)]
+    non_highlighted_df = df[~df[label_col].isin(sel_labels)]
+    labels = [(row[x_col], row[y_col], str(row[label_col]))
+              for _, row in highlighted_df.iterrows()]
+    return sel_labels, non_highlighted_df, labels
+
+
+def vectorized(df, x_col, y_col, label_col, annotate_col, top_n, cutoff):
+    sel_labels = get_annotate_labels(df, top_n, annotate_col, label_col,
+                                     False, cutoff, '')
+    data, highlighted = prepare_plot_data(df, x_col, y_col, False, True,
+                                          label_col, sel_labels)
+    highlighted_df = data[highlighted]
+    non_highlighted_df = data[~highlighted]
+    labels = list(zip(highlighted_df[x_col].to_numpy(),
+                      highlighted_df[y_col].to_numpy(),
+                      highlighted_df[label_col].astype(str).to_numpy()))
+    return sel_labels, non_highlighted_df, labels
+
+
+def best_of(func, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--top-n', type=int, default=50)
+    parser.add_argument('--cutoff', type=float, default=1e-6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_table(args.rows)
+    params = ('log2FoldChange', 'padj', 'gene', 'padj', args.top_n, args.cutoff)
+    legacy_time, legacy_result = best_of(legacy, args.repeat, df, *params)
+    new_time, new_result = best_of(vectorized, args.repeat, df, *params)
+
+    assert set(legacy_result[0]) == set(new_result[0])
+    assert len(legacy_result[1]) == len(new_result[1])
+    print(f"rows={args.rows} labels={len(new_result[0])}")
+    print(f"legacy:     {legacy_time * 1000:9.1f} ms")
+    print(f"vectorized: {new_time * 1000:9.1f} ms  ({legacy_time / new_time:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Production server settings, used with: gunicorn -c gunicorn.conf.py
+#
+# All workers share state through the file system only (upload spool, Arrow
+# datasets, figure cache, background jobs and metrics), so any worker can
+# serve any session. Point the ANNOFIG_*_DIR variables at the same local
+# directories for all workers (the defaults under the temp dir already are).
+import multiprocessing
+import os
+
+pythonpath = 'src'
+wsgi_app = 'wsgi:server'
+bind = os.environ.get('ANNOFIG_BIND', '0.0.0.0:8051')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('ANNOFIG_THREADS', 4))
+# Static renders run in the request thread when background rendering is off
+timeout = int(os.environ.get('ANNOFIG_TIMEOUT', 300))
+# Import the app once in the master so workers start quickly and share its pages
+preload_app = True
+accesslog = '-'
@@ -1,19 +1,34 @@
+import logging
+import os
 from dash import Dash
 from layouts import create_layout
 from callbacks import register_callbacks
+from uploads import register_upload_routes
+from background import create_background_manager
+from figcache import figure_cache, register_figure_routes
+from datastore import dataset_store
+from instrument import register_metrics_routes
 import dash_bootstrap_components as dbc
-# import os
 
 external_stylesheets = [dbc.themes.CERULEAN]
+background_manager = create_background_manager()
 # Initialize Dash app
 app = Dash(__name__, external_stylesheets=external_stylesheets,
-           url_base_pathname='/annofig/')
+           url_base_pathname='/annofig/',
+           background_callback_manager=background_manager,
+           assets_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      os.pardir, 'assets'))
 
 # Set layout
 app.layout = create_layout(app_title="AnnoFig")
 
 # Register callbacks
-register_callbacks(app)
+register_callbacks(app, background_manager)
+register_upload_routes(app.server, app.config.url_base_pathname)
+register_figure_routes(app.server, app.config.url_base_pathname)
+register_metrics_routes(app.server, app.config.url_base_pathname,
+                        gauges={'dataset': dataset_store.stats, 'figure': figure_cache.stats})
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     app.run(debug=True, host='0.0.0.0', port=8051)
@@ -0,0 +1,34 @@
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Directory where background render jobs exchange their results; set
+# ANNOFIG_BACKGROUND=0 to render in the request thread instead
+BACKGROUND_DIR = os.environ.get('ANNOFIG_BACKGROUND_DIR',
+                                os.path.join(tempfile.gettempdir(), 'annofig-background'))
+BACKGROUND_ENABLED = os.environ.get('ANNOFIG_BACKGROUND', '1') != '0'
+# Seconds a finished job result is kept if the browser never collects it
+BACKGROUND_EXPIRE = 600
+
+
+def create_background_manager(directory=BACKGROUND_DIR):
+    """Return a manager running background callbacks in worker processes.
+
+    Jobs are executed by ``DiskcacheManager`` in separate processes, so a
+    render does not block the web worker. When a callback is triggered again
+    while its previous job is still running, Dash terminates the stale job.
+    Returns None when disabled or when the optional ``diskcache``,
+    ``multiprocess`` and ``psutil`` packages are not installed; callbacks then
+    run synchronously.
+    """
+    if not BACKGROUND_ENABLED:
+        return None
+    try:
+        import diskcache
+        from dash import DiskcacheManager
+        return DiskcacheManager(diskcache.Cache(directory), expire=BACKGROUND_EXPIRE)
+    except ImportError as e:
+        logger.warning("Background rendering unavailable (%s), rendering synchronously", e)
+        return None
@@ -0,0 +1,275 @@
+"""Render static figures without the web app.
+
+Usage: python src/batch.py SPEC_OR_DIRECTORY [-o OUTPUT_DIR] [--format png|svg|pdf]
+                           [--defaults PARAMS_FILE] [--workers N] [--report REPORT.json]
+
+A spec is a JSON or YAML file (YAML needs PyYAML)::
+
+    {"defaults": {"x_col": "log2FoldChange", "y_col": "padj", "y_log": true,
+                  "y_revert": true, "label_col": "gene", "annotate_col": "padj",
+                  "top_n": 20},
+     "figures": [{"table": "a_vs_b.csv"},
+                 {"table": "a_vs_b.csv", "output": "a_vs_b_cutoff.pdf",
+                  "annotate_cutoff": 1e-10}]}
+
+Figure entries take the keyword arguments of ``generate_static_figure`` plus
+``table`` (relative paths are resolved against the spec file), and
+optionally ``output`` and ``format``. Given a directory instead of a spec,
+every supported table in it becomes one figure, using the parameters from
+``--defaults``. Figures are rendered by a process pool with one worker per
+core. The figures of a table are rendered by one worker, which parses the
+table once for all of them; only when there are fewer tables than workers
+are they split across the idle workers. This module does not import Dash.
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ingest import SUPPORTED_EXTENSIONS, is_supported, read_columns, read_table
+from labelindex import LabelIndex
+from utils import generate_static_figure, parse_manual_genes
+
+FORMATS = ('png', 'svg', 'pdf')
+# Parameters of generate_static_figure that can be set in a spec
+FIGURE_PARAMS = ('x_col', 'y_col', 'x_log', 'x_revert', 'y_log', 'y_revert',
+                 'point_size', 'point_color', 'theme', 'width', 'height',
+                 'label_col', 'annotate_col', 'top_n', 'annotate_cutoff',
+                 'annotate_revert', 'manual_genes', 'annotation_color',
+                 'annotation_font_size', 'annotation_font_color', 'force_text',
+                 'dpi', 'label_max_iter', 'label_time_budget', 'label_overflow',
+                 'background_mode')
+# Parsed tables kept by each worker process
+TABLE_CACHE_ENTRIES = 8
+
+
+def load_params(path):
+    """Read a JSON or YAML file (by extension) into a dict."""
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("Reading YAML specs requires PyYAML; use JSON instead")
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+
+def load_spec(source, defaults=None):
+    """Return the figure entries of a spec file or of a directory of tables.
+
+    Every entry has ``table`` (an absolute path) and the figure parameters,
+    with the spec's ``defaults`` (or ``defaults`` for a directory) applied.
+    """
+    defaults = dict(defaults or {})
+    if os.path.isdir(source):
+        tables = sorted(name for name in os.listdir(source) if is_supported(name))
+        entries = [{'table': name} for name in tables]
+        base_dir = os.path.abspath(source)
+    else:
+        spec = load_params(source)
+        defaults.update(spec.get('defaults', {}))
+        entries = spec.get('figures', [])
+        base_dir = os.path.dirname(os.path.abspath(source))
+    figures = []
+    for entry in entries:
+        figure = {**defaults, **entry}
+        if 'table' not in figure:
+            raise ValueError(f"Figure entry without a 'table': {entry}")
+        unknown = set(figure) - set(FIGURE_PARAMS) - {'table', 'output', 'format'}
+        if unknown:
+            raise ValueError(f"Unknown figure parameters: {', '.join(sorted(unknown))}")
+        figure['table'] = os.path.join(base_dir, figure['table'])
+        figures.append(figure)
+    return figures
+
+
+@functools.lru_cache(maxsize=TABLE_CACHE_ENTRIES)
+def _load_table(path, columns):
+    return read_table(path, os.path.basename(path), columns)
+
+
+@functools.lru_cache(maxsize=TABLE_CACHE_ENTRIES)
+def _label_index(path, columns, label_col):
+    return LabelIndex(_load_table(path, columns)[label_col])
+
+
+def _figure_columns(params):
+    return {params[name] for name in ('x_col', 'y_col', 'label_col', 'annotate_col')
+            if params.get(name)}
+
+
+def render_figure(table, output, fmt='png', columns=None, **params):
+    """Render one figure from the table at ``table`` into the file ``output``.
+
+    ``columns`` are the columns to load, by default those the figure uses;
+    figures of a table loading the same columns share the parsed table.
+    Returns a dict with the output path, the numbers of placed, overlapping
+    and dropped labels, the manual genes not found in the table and the load and render
+    times in seconds.
+    """
+    start = time.perf_counter()
+    if isinstance(params.get('manual_genes'), (list, tuple)):
+        params['manual_genes'] = ' '.join(params['manual_genes'])
+    columns = tuple(sorted(_figure_columns(params) if columns is None else columns))
+    df = _load_table(os.path.abspath(table), columns)
+    unmatched = []
+    if params.get('manual_genes') and params.get('label_col') in df.columns:
+        # Same matching as the app: case-insensitive, NAME* matches a prefix
+        index = _label_index(os.path.abspath(table), columns, params['label_col'])
+        params['manual_genes'], unmatched = index.match(parse_manual_genes(params['manual_genes']))
+    loaded = time.perf_counter()
+    image_bytes, report = generate_static_figure(df, fmt=fmt, return_report=True, **params)
+    with open(output, 'wb') as f:
+        f.write(image_bytes)
+    done = time.perf_counter()
+    return {'output': output, 'table': table,
+            'labels_placed': report.placed if report else 0,
+            'labels_overlapping': report.overlapping if report else 0,
+            'labels_dropped': report.dropped if report else 0,
+            'unmatched_genes': unmatched,
+            'load_seconds': loaded - start, 'render_seconds': done - loaded,
+            'seconds': done - start}
+
+
+def _render_entry(figure, columns=None):
+    figure = dict(figure)
+    table, output, fmt = figure.pop('table'), figure.pop('output'), figure.pop('format')
+    try:
+        return render_figure(table, output, fmt, columns, **figure)
+    except Exception as e:
+        return {'output': output, 'table': table, 'error': f'{type(e).__name__}: {e}'}
+
+
+def _render_entries(figures):
+    """Render figures, parsing each table once with the columns all its figures use."""
+    columns = {}
+    for figure in figures:
+        columns.setdefault(figure['table'], set()).update(_figure_columns(figure))
+    for table, needed in columns.items():
+        try:
+            # Columns missing from the table fail only the figures using them
+            columns[table] = needed & set(read_columns(table, os.path.basename(table)))
+        except Exception:
+            columns[table] = None  # reported by each figure of the table
+    return [_render_entry(figure, columns[figure['table']]) for figure in figures]
+
+
+def _table_stem(table):
+    """Return the file name of ``table`` without its table extension."""
+    name = os.path.basename(table)
+    for ext in sorted(SUPPORTED_EXTENSIONS, key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def output_paths(figures, output_dir='.'):
+    """Return the output path of every figure entry.
+
+    Entries without an ``output`` are named after their table (``x.v1.csv``
+    gives ``x.v1.png``), with ``_2``, ``_3``... appended when several figures
+    of a table, or tables differing only in extension, would get the same
+    name. Explicit outputs that clash raise ``ValueError``.
+    """
+    paths = [os.path.normpath(os.path.join(output_dir, figure['output']))
+             if figure.get('output') else None for figure in figures]
+    taken = set()
+    for path in paths:
+        if path is None:
+            continue
+        if path in taken:
+            raise ValueError(f"Several figures are written to {path}")
+        taken.add(path)
+    for k, figure in enumerate(figures):
+        if paths[k] is not None:
+            continue
+        stem = os.path.join(output_dir, _table_stem(figure['table']))
+        path, suffix = os.path.normpath(f"{stem}.{figure['format']}"), 1
+        while path in taken:
+            suffix += 1
+            path = os.path.normpath(f"{stem}_{suffix}.{figure['format']}")
+        taken.add(path)
+        paths[k] = path
+    return paths
+
+
+def render_batch(figures, output_dir='.', fmt='png', workers=None):
+    """Render figure entries (see ``load_spec``) in parallel.
+
+    Outputs are written to ``output_dir`` and named by ``output_paths``.
+    Returns one result dict per figure, in order; failed figures have an
+    ``error`` instead of timings.
+    """
+    entries = []
+    for figure in figures:
+        figure = dict(figure)
+        figure.setdefault('format', fmt)
+        if figure['format'] not in FORMATS:
+            raise ValueError(f"Unsupported output format: {figure['format']}")
+        entries.append(figure)
+    for figure, output in zip(entries, output_paths(entries, output_dir)):
+        figure['output'] = output
+    os.makedirs(output_dir, exist_ok=True)
+
+    # One task per table, so each table is parsed by a single worker. Tables
+    # are split into several tasks only to keep otherwise idle workers busy
+    by_table = {}
+    for k, figure in enumerate(entries):
+        by_table.setdefault(os.path.abspath(figure['table']), []).append(k)
+    workers = workers or os.cpu_count() or 1
+    splits = max(1, workers // max(len(by_table), 1))
+    tasks = []
+    for indexes in by_table.values():
+        size = -(-len(indexes) // min(splits, len(indexes)))
+        tasks.extend(indexes[i:i + size] for i in range(0, len(indexes), size))
+    results = [None] * len(entries)
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(tasks), 1))) as pool:
+        chunks = pool.map(_render_entries, [[entries[k] for k in task] for task in tasks])
+        for task, chunk in zip(tasks, chunks):
+            for k, result in zip(task, chunk):
+                results[k] = result
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='JSON/YAML spec file, or a directory of tables')
+    parser.add_argument('-o', '--output-dir', default='.')
+    parser.add_argument('--format', choices=FORMATS, default='png',
+                        help='output format of figures that do not set one')
+    parser.add_argument('--defaults', help='JSON/YAML file of figure parameters for all figures')
+    parser.add_argument('--workers', type=int, help='number of processes (default: one per core)')
+    parser.add_argument('--report', help='write the per-figure results to this JSON file')
+    args = parser.parse_args(argv)
+
+    defaults = load_params(args.defaults) if args.defaults else {}
+    figures = load_spec(args.source, defaults)
+    start = time.perf_counter()
+    results = render_batch(figures, args.output_dir, args.format, args.workers)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for result in results:
+        if 'error' in result:
+            failed += 1
+            print(f"FAILED {result['output']}: {result['error']}", file=sys.stderr)
+        else:
+            print(f"{result['output']}: {result['seconds']:.2f} s "
+                  f"(load {result['load_seconds']:.2f} s, render {result['render_seconds']:.2f} s, "
+                  f"labels {result['labels_placed']} placed, {result['labels_overlapping']} overlapping, "
+                  f"{result['labels_dropped']} dropped)")
+            if result['unmatched_genes']:
+                print(f"  not found: {', '.join(map(str, result['unmatched_genes']))}", file=sys.stderr)
+    print(f"Rendered {len(results) - failed} of {len(results)} figures in {elapsed:.2f} s")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
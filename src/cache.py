@@ -0,0 +1,115 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+# Objects whose locks are replaced in forked children, see ``register_fork_safe``
+_fork_safe = weakref.WeakSet()
+
+
+def register_fork_safe(obj):
+    """Call ``obj._reset_locks()`` in every child forked from this process.
+
+    A forked child (e.g. a background render job) gets copies of the locks
+    held by other threads of the parent at that moment, and nothing in the
+    child ever releases them; objects used from threads and forked children
+    replace their locks there.
+    """
+    _fork_safe.add(obj)
+
+
+def _reset_after_fork():
+    for obj in list(_fork_safe):
+        obj._reset_locks()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class SizedLRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values.
+
+    ``sizeof`` is called once per inserted value and must return its size in
+    bytes. Least recently used entries are evicted until the total fits into
+    ``max_bytes``; a single value larger than the cap is not cached at all.
+    """
+
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        register_fork_safe(self)
+
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Like ``get`` but without touching recency or hit statistics."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
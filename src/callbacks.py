@@ -1,23 +1,135 @@
-from dash import Input, Output, State
+import json
 import pandas as pd
-import plotly.express as px
-from utils import parse_data, generate_interactive_figure, generate_static_figure, b64_image
-import base64
-import io
+from dash import ClientsideFunction, Input, Output, State, ctx, dcc, no_update
+from dash.exceptions import PreventUpdate
+from utils import (generate_interactive_figure, generate_static_figure, b64_png,
+                   decode_contents, parse_relayout_view, view_signature, parse_manual_genes,
+                   DENSITY_THRESHOLD)
+from datastore import dataset_store
+from pointindex import axis_units
+from figcache import figure_cache, figure_key
+from uploads import upload_spool
+from ingest import is_supported
+from instrument import instrument_callback, stage
 from dash import html
 
 
-def register_callbacks(app):
+# Suggestions shown while searching labels to annotate
+LABEL_SUGGESTIONS = 20
+# Unmatched names listed in the report below the manual genes input
+UNMATCHED_SHOWN = 20
+
+
+def resolve_manual_genes(dataset_id, label_col, manual_genes):
+    """Return the labels of the dataset matching the entered names.
+
+    Names match case-insensitively and ``NAME*`` matches every label with
+    that prefix (see ``LabelIndex.match``).
+    """
+    names = parse_manual_genes(manual_genes)
+    if not names or not label_col:
+        return names
+    index = dataset_store.label_index(dataset_id, label_col)
+    return index.match(names)[0] if index is not None else names
+
+
+def annotation_overrides(dataset_id, label_col, manual_genes, selected_labels):
+    """Return the manually chosen labels and the labels never to annotate.
+
+    The first are the entered names resolved to labels plus the points added
+    by selecting them on the interactive figure; the second the selected
+    points removed from the labels.
+    """
+    manual = resolve_manual_genes(dataset_id, label_col, manual_genes)
+    selected_labels = selected_labels or {}
+    return manual + selected_labels.get('added', []), selected_labels.get('removed', [])
+
+
+def selection_rows(index, trigger, selection, click_data, x_log, y_log):
+    """Return the row positions picked by a click, box or lasso selection."""
+    if trigger == 'interactive-figure':
+        point = (click_data or {}).get('points', [None])[0]
+        if not point or point.get('x') is None or point.get('y') is None:
+            return []
+        row = index.nearest(axis_units(point['x'], x_log), axis_units(point['y'], y_log))
+        return [] if row is None else [row]
+    if not selection:
+        return []
+    # Box and lasso regions are in axis units (log10 on log axes) already
+    if selection.get('lassoPoints'):
+        return index.polygon(selection['lassoPoints']['x'], selection['lassoPoints']['y'])
+    if selection.get('range'):
+        return index.box(selection['range']['x'], selection['range']['y'])
+    return []
+
+
+def render_static_figure(dataset_id, params, selected_labels, fmt='png'):
+    """Render the static figure of a dataset in the image format ``fmt``.
+
+    ``params`` are the keyword arguments of ``generate_static_figure`` as set
+    in the app. Returns ``(image_bytes, LabelReport)``, or ``None`` if the
+    upload has expired.
+    """
+    df = dataset_store.load(dataset_id, [params['x_col'], params['y_col'],
+                                         params['label_col'], params['annotate_col']])
+    if df is None:
+        return None
+    manual_genes, excluded_labels = annotation_overrides(
+        dataset_id, params['label_col'], params['manual_genes'], selected_labels)
+    return generate_static_figure(df, **dict(params, manual_genes=manual_genes),
+                                  excluded_labels=excluded_labels, fmt=fmt, return_report=True)
+
+
+def render_figure_download(figure, ext):
+    """Return a static figure in the download format ``ext``, cached by key.
+
+    ``figure`` is the ``static-figure-spec`` set by the static figure
+    callback: its cache key plus the dataset and settings to render it from.
+    Returns ``None`` if the upload has expired.
+    """
+    data = figure_cache.get(figure['key'], ext)
+    if data is None:
+        rendered = render_static_figure(figure['dataset_id'], figure['params'],
+                                        figure['selected_labels'], ext)
+        if rendered is None:
+            return None
+        data = rendered[0]
+        figure_cache.put(figure['key'], ext, data)
+    return data
+
+
+def register_callbacks(app, background_manager=None):
     
+    # Store the upload server-side once; callbacks only receive its dataset ID.
+    # Large files bypass this callback and are streamed in chunks by
+    # assets/chunked_upload.js, which sets 'dataset-id' directly.
+    @app.callback(
+        Output('dataset-id', 'data'),
+        Input('upload-data', 'contents'),
+        State('upload-data', 'filename'),
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def store_upload(contents, filename):
+        if contents is None:
+            raise PreventUpdate
+        with stage('decode') as info:
+            data = decode_contents(contents)
+            info['bytes'] = len(data)
+        return upload_spool.save(data, filename)
+
     @app.callback(
         [Output('x-axis', 'options'), Output('y-axis', 'options'),
          Output('label-column', 'options'), Output('annotate-column', 'options')],
-        [Input('upload-data', 'contents')],
+        [Input('dataset-id', 'data')],
         prevent_initial_call=True
     )
-    def update_columns(file_content):
-        df = parse_data(file_content)
-        options = [{'label': col, 'value': col} for col in df.columns]
+    @instrument_callback
+    def update_columns(dataset_id):
+        columns = dataset_store.columns(dataset_id)
+        if columns is None:
+            raise PreventUpdate
+        options = [{'label': col, 'value': col} for col in columns]
         return options, options, options, options
 
     @app.callback(
@@ -25,33 +137,172 @@ def register_callbacks(app):
         [Input('x-axis', 'value'), Input('y-axis', 'value'),
         Input('x-log-scale', 'value'), Input('x-revert', 'value'),
         Input('y-log-scale', 'value'), Input('y-revert', 'value'),
-        Input('point-size', 'value'),
-        Input('point-color', 'value'), Input('theme', 'value'),
         Input('label-column', 'value'), Input('annotate-column', 'value'), 
         Input('ranking-top-n', 'value'), Input('annotate-cutoff', 'value'),
         Input('annotate-revert', 'value'), Input('manual-genes', 'value'),
-        Input('annotation-color', 'value'), Input('annotation-font-size', 'value'),
-        Input('annotation-font-color', 'value'), Input('force-text', 'value')],
-        [State('upload-data', 'contents')],
+        Input('interactive-view', 'data'), Input('selected-labels', 'data')],
+        # Styles are applied in the browser when they change (see
+        # assets/presentation.js); new figures are built with the current ones
+        [State('point-size', 'value'), State('point-color', 'value'), State('theme', 'value'),
+         State('annotation-color', 'value'), State('annotation-font-size', 'value'),
+         State('annotation-font-color', 'value'),
+         State('force-text', 'value'), State('dataset-id', 'data')],
         prevent_initial_call=True
     )
+    @instrument_callback
     def update_interactive_figure(x_col, y_col, x_log, x_revert, y_log, y_revert,
-                                  point_size, point_color, theme,
                                   label_col, annotate_col, 
                                   top_n, annotate_cutoff,
-                                  annotate_revert, manual_genes, annotation_color,
-                                  annotation_font_size, annotation_font_color, force_text, file_content):
-        df = parse_data(file_content)
-        figure = generate_interactive_figure(
-            df, x_col, y_col, x_log, x_revert, y_log, y_revert, 
-            point_size, point_color, theme, label_col, annotate_col,
-            top_n, annotate_cutoff, annotate_revert, manual_genes, annotation_color,
-            annotation_font_size, annotation_font_color, force_text
-        )
-        return figure
+                                  annotate_revert, manual_genes,
+                                  stored_view, selected_labels,
+                                  point_size, point_color, theme, annotation_color,
+                                  annotation_font_size, annotation_font_color,
+                                  force_text, dataset_id):
+        if x_col is None or y_col is None:
+            raise PreventUpdate
+        df = dataset_store.load(dataset_id, [x_col, y_col, label_col, annotate_col])
+        if df is None:
+            raise PreventUpdate
+        # Zooming only needs a new figure when the background is binned
+        if ctx.triggered_id == 'interactive-view' and len(df) <= DENSITY_THRESHOLD:
+            raise PreventUpdate
+        # The view only matters (and only goes into the key) when binning
+        view = None
+        signature = view_signature(x_col, y_col, x_log, y_log, x_revert, y_revert)
+        if (len(df) > DENSITY_THRESHOLD and stored_view
+                and stored_view['signature'] == signature):
+            view = stored_view['view']
+        key = figure_key(
+            'interactive', dataset_id, x_col=x_col, y_col=y_col, x_log=x_log,
+            x_revert=x_revert, y_log=y_log, y_revert=y_revert, point_size=point_size,
+            point_color=point_color, theme=theme, label_col=label_col,
+            annotate_col=annotate_col, top_n=top_n, annotate_cutoff=annotate_cutoff,
+            annotate_revert=annotate_revert, manual_genes=manual_genes,
+            annotation_color=annotation_color, annotation_font_size=annotation_font_size,
+            annotation_font_color=annotation_font_color, view=view,
+            selected_labels=selected_labels)
+        figure_json = figure_cache.get(key, 'json')
+        if figure_json is None:
+            manual_genes, excluded_labels = annotation_overrides(
+                dataset_id, label_col, manual_genes, selected_labels)
+            with stage('interactive.build', rows=len(df)):
+                figure = generate_interactive_figure(
+                    df, x_col, y_col, x_log, x_revert, y_log, y_revert, 
+                    point_size, point_color, theme, label_col, annotate_col,
+                    top_n, annotate_cutoff, annotate_revert, manual_genes, annotation_color,
+                    annotation_font_size, annotation_font_color, force_text, view=view,
+                    excluded_labels=excluded_labels
+                )
+            with stage('interactive.serialize') as info:
+                figure_json = figure.to_json().encode('utf-8')
+                info['bytes'] = len(figure_json)
+            figure_cache.put(key, 'json', figure_json)
+        return json.loads(figure_json)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='annofig', function_name='styleInteractiveFigure'),
+        Output('interactive-figure', 'figure', allow_duplicate=True),
+        [Input('point-size', 'value'), Input('point-color', 'value'), Input('theme', 'value'),
+         Input('annotation-color', 'value'), Input('annotation-font-size', 'value'),
+         Input('annotation-font-color', 'value')],
+        [State('interactive-figure', 'figure'), State('figure-templates', 'data')],
+        prevent_initial_call=True
+    )
 
+    # Track the zoomed region of the interactive figure, tagged with the axes
+    # setup it belongs to, so that binned backgrounds are re-aggregated on zoom
     @app.callback(
-        Output('static-figure', 'src'),
+        Output('interactive-view', 'data'),
+        Input('interactive-figure', 'relayoutData'),
+        [State('interactive-view', 'data'),
+         State('x-axis', 'value'), State('y-axis', 'value'),
+         State('x-log-scale', 'value'), State('x-revert', 'value'),
+         State('y-log-scale', 'value'), State('y-revert', 'value')],
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def update_interactive_view(relayout_data, stored_view, x_col, y_col,
+                                x_log, x_revert, y_log, y_revert):
+        if not relayout_data:
+            raise PreventUpdate
+        signature = view_signature(x_col, y_col, x_log, y_log, x_revert, y_revert)
+        previous = {'x': None, 'y': None}
+        if stored_view and stored_view['signature'] == signature:
+            previous = stored_view['view']
+        view = parse_relayout_view(relayout_data, previous)
+        if view == previous:
+            raise PreventUpdate
+        return {'signature': signature, 'view': view}
+
+    # Forward only the region of a box or lasso selection, not its points
+    app.clientside_callback(
+        ClientsideFunction(namespace='annofig', function_name='selectionRegion'),
+        Output('interactive-selection', 'data'),
+        Input('interactive-figure', 'selectedData'),
+        prevent_initial_call=True
+    )
+
+    # Add points picked on the interactive figure to the labels, or remove
+    # them; a new dataset, label column or the clear button resets the choice
+    @app.callback(
+        Output('selected-labels', 'data'),
+        [Input('interactive-selection', 'data'), Input('interactive-figure', 'clickData'),
+         Input('clear-selection', 'n_clicks'), Input('dataset-id', 'data'),
+         Input('label-column', 'value')],
+        [State('selection-mode', 'value'), State('selected-labels', 'data'),
+         State('x-axis', 'value'), State('y-axis', 'value'),
+         State('x-log-scale', 'value'), State('y-log-scale', 'value')],
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def update_selected_labels(selection, click_data, clear_clicks, dataset_id, label_col,
+                               mode, selected_labels, x_col, y_col, x_log, y_log):
+        empty = {'added': [], 'removed': []}
+        selected_labels = selected_labels or empty
+        if ctx.triggered_id in ('clear-selection', 'dataset-id', 'label-column'):
+            if selected_labels == empty:
+                raise PreventUpdate
+            return empty
+        if not label_col or x_col is None or y_col is None:
+            raise PreventUpdate
+        index = dataset_store.point_index(dataset_id, x_col, y_col, x_log, y_log)
+        if index is None:
+            raise PreventUpdate
+        with stage('select') as info:
+            rows = selection_rows(index, ctx.triggered_id, selection, click_data, x_log, y_log)
+            info['rows'] = len(rows)
+        if not len(rows):
+            raise PreventUpdate
+        df = dataset_store.load(dataset_id, [label_col])
+        if df is None or label_col not in df:
+            raise PreventUpdate
+        labels = df[label_col]
+        picked = pd.unique(labels.iloc[rows].dropna().to_numpy(dtype=object)).tolist()
+        picked_set = set(picked)
+        added = [label for label in selected_labels['added'] if label not in picked_set]
+        removed = [label for label in selected_labels['removed'] if label not in picked_set]
+        if mode == 'remove':
+            removed += picked
+        else:
+            added += picked
+        return {'added': added, 'removed': removed}
+
+    # Static renders run in a worker process when a background manager is
+    # available; a new trigger terminates the render still running for the
+    # previous one. The status line is shown while a render is in progress.
+    static_render_options = dict(running=[
+        (Output('static-render-status', 'style'), {'display': 'block'}, {'display': 'none'}),
+        (Output('static-figure-container', 'style'), {'opacity': 0.5}, {'opacity': 1}),
+    ])
+    if background_manager is not None:
+        static_render_options.update(background=True, manager=background_manager)
+    # Figures rendered in another process are only visible to the figure route
+    # through the disk tier of the cache; otherwise they are sent inline
+    served_by_route = bool(figure_cache.directory) or background_manager is None
+
+    @app.callback(
+        [Output('static-figure', 'src'), Output('label-report', 'children'),
+         Output('download-png', 'href'), Output('static-figure-spec', 'data')],
         [Input('x-axis', 'value'), Input('y-axis', 'value'),
         Input('x-log-scale', 'value'), Input('x-revert', 'value'),
         Input('y-log-scale', 'value'), Input('y-revert', 'value'),
@@ -62,48 +313,155 @@ def register_callbacks(app):
         Input('ranking-top-n', 'value'), Input('annotate-cutoff', 'value'),
         Input('annotate-revert', 'value'), Input('manual-genes', 'value'),
         Input('annotation-color', 'value'), Input('annotation-font-size', 'value'),
-        Input('annotation-font-color', 'value'), Input('force-text', 'value')],
-        [State('upload-data', 'contents')],
-        prevent_initial_call=True
+        Input('annotation-font-color', 'value'), Input('force-text', 'value'),
+        Input('selected-labels', 'data'), Input('static-background', 'value')],
+        [State('dataset-id', 'data')],
+        prevent_initial_call=True,
+        **static_render_options
     )
+    @instrument_callback
     def update_static_figure(x_col, y_col, x_log, x_revert, y_log, y_revert,
                              point_size, point_color, theme, width, height,
                              label_col, annotate_col, 
                              top_n, annotate_cutoff,
                              annotate_revert, manual_genes, annotation_color,
-                             annotation_font_size, annotation_font_color, force_text, file_content):
-        df = parse_data(file_content)
-        static_img_path = generate_static_figure(
-            df, x_col, y_col, x_log, x_revert, y_log, y_revert, 
-            point_size, point_color, theme,  width, height, label_col, annotate_col,
-            top_n, annotate_cutoff, annotate_revert, manual_genes, annotation_color,
-            annotation_font_size, annotation_font_color, force_text
-        )
+                             annotation_font_size, annotation_font_color, force_text,
+                             selected_labels, background_mode, dataset_id):
+        params = dict(
+            x_col=x_col, y_col=y_col, x_log=x_log, x_revert=x_revert, y_log=y_log,
+            y_revert=y_revert, point_size=point_size, point_color=point_color, theme=theme,
+            width=width, height=height, label_col=label_col, annotate_col=annotate_col,
+            top_n=top_n, annotate_cutoff=annotate_cutoff, annotate_revert=annotate_revert,
+            manual_genes=manual_genes, annotation_color=annotation_color,
+            annotation_font_size=annotation_font_size,
+            annotation_font_color=annotation_font_color, force_text=force_text,
+            background_mode=background_mode)
+        key = figure_key('static', dataset_id, selected_labels=selected_labels, **params)
+        png_bytes = figure_cache.get(key, 'png')
+        report_text = figure_cache.get(key, 'txt')
+        if png_bytes is None or report_text is None:
+            rendered = render_static_figure(dataset_id, params, selected_labels, 'png')
+            if rendered is None:
+                raise PreventUpdate
+            png_bytes, report = rendered
+            report_text = b""
+            if report is not None and (report.overlapping or report.dropped):
+                report_text = (f"Labels placed: {report.placed}, overlapping: {report.overlapping} "
+                               f"(too crowded to keep apart), dropped: {report.dropped} "
+                               "(over the label budget; lower-ranked labels are dropped first)"
+                               ).encode('utf-8')
+            figure_cache.put(key, 'png', png_bytes)
+            figure_cache.put(key, 'txt', report_text)
+        # Served by the figure route when possible, so the browser caches it
+        src = app.get_relative_path(f'/_figures/{key}.png') if served_by_route else b64_png(png_bytes)
+        spec = {'key': key, 'dataset_id': dataset_id, 'params': params,
+                'selected_labels': selected_labels}
+        return src, report_text.decode('utf-8'), src, spec
+
+    # SVG and PDF are rendered only when their download is requested, in the
+    # background like the PNG, and sent to the browser by the download
+    # component. The buttons are hidden while the file is being prepared.
+    download_render_options = dict(running=[
+        (Output('download-vector', 'style'), {'display': 'none'}, {'display': 'inline'}),
+        (Output('download-status', 'style'), {'display': 'inline'}, {'display': 'none'}),
+    ])
+    if background_manager is not None:
+        download_render_options.update(background=True, manager=background_manager)
+
+    @app.callback(
+        Output('download-file', 'data'),
+        [Input('download-svg', 'n_clicks'), Input('download-pdf', 'n_clicks')],
+        State('static-figure-spec', 'data'),
+        prevent_initial_call=True,
+        **download_render_options
+    )
+    @instrument_callback
+    def download_figure(svg_clicks, pdf_clicks, figure):
+        if not figure:
+            raise PreventUpdate
+        ext = 'svg' if ctx.triggered_id == 'download-svg' else 'pdf'
+        data = render_figure_download(figure, ext)
+        if data is None:
+            raise PreventUpdate
+        return dcc.send_bytes(data, f'annofig.{ext}')
 
-        return b64_image(static_img_path)
+    # Autocomplete labels to annotate from the index of the label column; the
+    # options are computed on the server, so they work for any number of labels
+    @app.callback(
+        Output('label-search', 'options'),
+        Input('label-search', 'search_value'),
+        [State('label-column', 'value'), State('dataset-id', 'data')],
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def update_label_suggestions(search_value, label_col, dataset_id):
+        if not search_value or not label_col:
+            raise PreventUpdate
+        index = dataset_store.label_index(dataset_id, label_col)
+        if index is None:
+            raise PreventUpdate
+        return [{'label': str(label), 'value': str(label)}
+                for label in index.complete(search_value, LABEL_SUGGESTIONS)]
+
+    # Add the picked suggestion to the manually entered genes
+    @app.callback(
+        [Output('manual-genes', 'value'), Output('label-search', 'value')],
+        Input('label-search', 'value'),
+        State('manual-genes', 'value'),
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def add_manual_gene(label, manual_genes):
+        if not label:
+            raise PreventUpdate
+        if label in parse_manual_genes(manual_genes):
+            return no_update, None
+        return f"{(manual_genes or '').strip()} {label}".strip(), None
+
+    # Report the entered names that match no label
+    @app.callback(
+        Output('manual-genes-report', 'children'),
+        [Input('manual-genes', 'value'), Input('label-column', 'value'),
+         Input('dataset-id', 'data')],
+        prevent_initial_call=True
+    )
+    @instrument_callback
+    def update_manual_genes_report(manual_genes, label_col, dataset_id):
+        names = parse_manual_genes(manual_genes)
+        if not names or not label_col:
+            return ""
+        index = dataset_store.label_index(dataset_id, label_col)
+        if index is None:
+            return ""
+        unmatched = index.match(names)[1]
+        if not unmatched:
+            return ""
+        shown = ', '.join(unmatched[:UNMATCHED_SHOWN])
+        more = f", ... ({len(unmatched) - UNMATCHED_SHOWN} more)" if len(unmatched) > UNMATCHED_SHOWN else ""
+        return f"Not found in {label_col} ({len(unmatched)} of {len(names)}): {shown}{more}"
 
     # Callback to process the uploaded file and display its info
     @app.callback(
         Output('file-info', 'children'),
-        Input('upload-data', 'contents'),
-        State('upload-data', 'filename')
+        Input('dataset-id', 'data')
     )
-    def update_file_info(contents, filename):
-        if contents is None:
+    @instrument_callback
+    def update_file_info(dataset_id):
+        if dataset_id is None:
             return ""
         
-        # Decode the uploaded file
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-        
         # Check file type and load data
         try:
-            if filename.endswith('.csv'):
-                df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-            elif filename.endswith(('.xls', '.xlsx')):
-                df = pd.read_excel(io.BytesIO(decoded), sheet_name=0)
-            else:
+            filename = upload_spool.filename(dataset_id)
+            if not is_supported(filename):
                 return "Unsupported file format"
+            columns = dataset_store.columns(dataset_id)
+            if columns is None:
+                return "The uploaded file has expired, please upload it again"
+            # A single column is enough to count the rows
+            df = dataset_store.load(dataset_id, columns[:1])
+            if df is None:
+                return "The uploaded file has expired, please upload it again"
             
             # Get the number of rows
             row_count = len(df)
@@ -113,17 +471,9 @@ def register_callbacks(app):
         except Exception as e:
             return f"Error processing file: {str(e)}"
         
-    # Callback to update the width and height of both figures
-    @app.callback(
-        [Output('interactive-figure', 'style'),
-        Output('static-figure', 'style')],
-        [Input('width', 'value'),
-        Input('height', 'value')]
+    # Width and height of both figures, set in the browser
+    app.clientside_callback(
+        ClientsideFunction(namespace='annofig', function_name='figureSize'),
+        [Output('interactive-figure', 'style'), Output('static-figure', 'style')],
+        [Input('width', 'value'), Input('height', 'value')]
     )
-    def update_figure_size(width, height):
-        # Define the style dictionaries with dynamic width and height
-        new_style = {
-            'width': f'{width}px' if width else '600px',  # Default to 600px if None
-            'height': f'{height}px' if height else '600px'  # Default to 600px if None
-        }
-        return new_style, new_style
\ No newline at end of file
@@ -0,0 +1,186 @@
+import contextlib
+import logging
+import os
+import threading
+
+import pandas as pd
+
+from cache import SizedLRUCache, register_fork_safe
+from ingest import read_arrow, read_columns, read_table, write_arrow
+from instrument import stage
+from labelindex import LabelIndex
+from pointindex import PointIndex
+from uploads import upload_spool
+
+logger = logging.getLogger(__name__)
+
+# Memory cap for parsed DataFrames kept across callbacks (in MB)
+DATASET_CACHE_MB = int(os.environ.get('ANNOFIG_DATASET_CACHE_MB', 1024))
+# Number of datasets whose column names are remembered
+COLUMN_CACHE_ENTRIES = 1024
+# Memory cap for the label and point indexes of datasets (in MB)
+INDEX_CACHE_MB = int(os.environ.get('ANNOFIG_INDEX_CACHE_MB', 256))
+# 'memory': every process parses the uploads it needs; 'arrow': each upload is
+# converted once to an Arrow file next to it, which all processes memory-map
+DATASET_TIER = os.environ.get('ANNOFIG_DATASET_TIER', 'memory')
+DATASET_TIERS = ('memory', 'arrow')
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class DatasetStore:
+    """Parse every upload once and keep the DataFrame in a bounded LRU.
+
+    Frames are keyed by the dataset ID handed out by the upload spool (the
+    SHA-256 of the file) and the columns loaded from it, so the same file
+    uploaded twice (or by two sessions) is parsed once. Only the columns a
+    figure needs are loaded, with compact dtypes (see ``ingest``). Cached
+    frames are shared between callbacks and must be treated as read-only.
+
+    With the ``'arrow'`` tier the first process to load an upload converts
+    it to an uncompressed Arrow file in the spool; from then on every
+    process memory-maps that file instead of parsing the upload, so a table
+    is resident once no matter how many worker processes use it.
+    """
+
+    def __init__(self, max_bytes, spool, tier='memory', max_index_bytes=0):
+        if tier not in DATASET_TIERS:
+            raise ValueError(f"Unknown dataset tier: {tier}")
+        self.tier = tier
+        self._cache = SizedLRUCache(max_bytes, sizeof=frame_nbytes)
+        self._columns = SizedLRUCache(COLUMN_CACHE_ENTRIES, sizeof=lambda columns: 1)
+        self._indexes = SizedLRUCache(max_index_bytes, sizeof=lambda index: index.nbytes)
+        self._spool = spool
+        self._parse_locks = {}
+        self._locks_guard = threading.Lock()
+        register_fork_safe(self)
+
+    def _reset_locks(self):
+        # Loads running in other threads of the parent never finish here
+        self._parse_locks = {}
+        self._locks_guard = threading.Lock()
+
+    def columns(self, dataset_id):
+        """Return the column names of ``dataset_id``, or ``None`` if unknown."""
+        if not dataset_id:
+            return None
+        columns = self._columns.get(dataset_id)
+        if columns is None and self._spool.exists(dataset_id):
+            columns = read_columns(self._spool.path(dataset_id),
+                                   self._spool.filename(dataset_id))
+            self._columns.put(dataset_id, columns)
+        return columns
+
+    def load(self, dataset_id, columns=None):
+        """Return the frame for ``dataset_id``, parsing it only on a miss.
+
+        ``columns`` selects the columns to load (``None`` entries and names
+        not in the table are skipped); all columns are loaded by default.
+        Returns ``None`` if the upload is unknown or has expired.
+        """
+        available = self.columns(dataset_id)
+        if available is None:
+            return None
+        if columns is not None:
+            columns = tuple(sorted({col for col in columns if col in available}))
+            if not columns:
+                return pd.DataFrame()
+        key = (dataset_id, columns)
+        df = self._cache.get(key)
+        if df is not None:
+            return df
+        # Callbacks fired by the same upload race here; parse only once
+        with self._build_lock(key):
+            df = self._cache.peek(key)
+            if df is None:
+                # The column names outlive the upload, which the spool may
+                # have removed since they were cached
+                try:
+                    with stage('parse') as info:
+                        df = self._read(dataset_id, columns)
+                        info.update(rows=len(df), bytes=frame_nbytes(df))
+                except FileNotFoundError:
+                    self._columns.pop(dataset_id)
+                    logger.info("Dataset %s has expired", dataset_id[:12])
+                    return None
+                if not self._cache.put(key, df):
+                    logger.warning("Dataset %s (%d bytes) exceeds the cache cap",
+                                   dataset_id[:12], frame_nbytes(df))
+                logger.info("Parsed dataset %s (%d rows, columns %s); cache stats: %s",
+                            dataset_id[:12], len(df), list(df.columns), self.stats())
+        return df
+
+    def label_index(self, dataset_id, label_col):
+        """Return the ``LabelIndex`` of a column, building it once per dataset.
+
+        Returns ``None`` if the upload is unknown or has no such column.
+        """
+        return self._index(('label_index', dataset_id, label_col), [label_col],
+                           lambda df: LabelIndex(df[label_col]))
+
+    def point_index(self, dataset_id, x_col, y_col, x_log=False, y_log=False):
+        """Return the ``PointIndex`` of two plotted columns, building it once.
+
+        Returns ``None`` if the upload is unknown or lacks one of the columns.
+        """
+        x_log, y_log = bool(x_log), bool(y_log)
+        return self._index(('point_index', dataset_id, x_col, y_col, x_log, y_log), [x_col, y_col],
+                           lambda df: PointIndex(df[x_col], df[y_col], x_log, y_log))
+
+    def _index(self, key, columns, build):
+        index = self._indexes.get(key)
+        if index is not None:
+            return index
+        kind, dataset_id = key[:2]
+        with self._build_lock(key):
+            index = self._indexes.peek(key)
+            if index is None:
+                df = self.load(dataset_id, columns)
+                if df is None or not set(columns) <= set(df.columns):
+                    return None
+                with stage(kind, rows=len(df)):
+                    index = build(df)
+                self._indexes.put(key, index)
+                logger.info("Built %s of dataset %s over %s (%d entries)",
+                            kind, dataset_id[:12], columns, len(index))
+        return index
+
+    @contextlib.contextmanager
+    def _build_lock(self, key):
+        with self._locks_guard:
+            lock = self._parse_locks.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                yield
+        finally:
+            with self._locks_guard:
+                self._parse_locks.pop(key, None)
+
+    def _read(self, dataset_id, columns):
+        source = self._spool.path(dataset_id)
+        filename = self._spool.filename(dataset_id)
+        if self.tier == 'memory':
+            return read_table(source, filename, columns)
+        arrow_path = self._spool.derived_path(dataset_id, '.arrow')
+        # Loads of different columns convert the same upload; one thread per
+        # process converts it. Processes racing here each write a complete
+        # file and the last atomic rename wins, so readers never see a
+        # partial file
+        with self._build_lock(('convert', dataset_id)):
+            if not os.path.exists(arrow_path):
+                with stage('convert') as info:
+                    df = read_table(source, filename)
+                    write_arrow(df, arrow_path)
+                    info.update(rows=len(df), bytes=os.path.getsize(arrow_path))
+                logger.info("Converted dataset %s to %s", dataset_id[:12], arrow_path)
+        return read_arrow(arrow_path, columns)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+dataset_store = DatasetStore(max_bytes=DATASET_CACHE_MB * 1024 ** 2,
+                             spool=upload_spool, tier=DATASET_TIER,
+                             max_index_bytes=INDEX_CACHE_MB * 1024 ** 2)
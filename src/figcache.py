@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from cache import SizedLRUCache, register_fork_safe
+from utils import normalize_color, parse_manual_genes
+
+logger = logging.getLogger(__name__)
+
+# Memory cap for rendered figures (in MB), and the directory and cap of the
+# on-disk tier shared by all worker processes (an empty directory disables it)
+FIGURE_CACHE_MB = int(os.environ.get('ANNOFIG_FIGURE_CACHE_MB', 256))
+FIGURE_CACHE_DIR = os.environ.get('ANNOFIG_FIGURE_CACHE_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'annofig-figures'))
+FIGURE_DISK_CACHE_MB = int(os.environ.get('ANNOFIG_FIGURE_DISK_CACHE_MB', 2048))
+# Bump when the renderers change, so outdated figures on disk are not served
+RENDER_VERSION = 2
+
+_FIGURE_KEY = re.compile(r'^[0-9a-f]{64}$')
+# Figure formats served over HTTP, by cache entry extension
+FIGURE_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf'}
+# Browsers revalidate after this many seconds (answered with 304 while unchanged)
+FIGURE_MAX_AGE = 3600
+
+
+def _canonical(name, value):
+    if name == 'manual_genes':
+        return parse_manual_genes(value) or None
+    value = normalize_color(value)
+    if isinstance(value, str) and value.startswith('#'):
+        return value.lower()
+    if isinstance(value, (list, tuple)):
+        return sorted(value) or None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value if value != '' else None
+
+
+def figure_key(kind, dataset_id, **params):
+    """Return the cache key of a figure rendered from a dataset.
+
+    Parameters are canonicalized so that equivalent settings share a key:
+    colour picker values become lowercase hex strings, manual gene lists are
+    split and sorted, and empty values (``None``, ``''``, ``[]``) are equal.
+    """
+    canonical = {name: _canonical(name, value) for name, value in params.items()}
+    payload = json.dumps([RENDER_VERSION, kind, dataset_id, canonical],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FigureCache:
+    """Two-tier cache for rendered figures, keyed by ``figure_key``.
+
+    Entries are byte strings stored under ``(key, ext)``, e.g. a PNG under
+    ``'png'`` or a serialized Plotly figure under ``'json'``. The memory tier
+    is a byte-bounded LRU. The optional disk tier keeps ``<key>.<ext>`` files
+    in ``directory``; it is shared between processes (background renders run
+    in their own process) and survives restarts. Its least recently used
+    files are removed once it grows beyond ``max_disk_bytes``.
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self._memory = SizedLRUCache(max_bytes, sizeof=len)
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self._disk_bytes = None  # computed on first write
+        register_fork_safe(self)
+
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, f'{key}.{ext}')
+
+    def get(self, key, ext):
+        data = self._memory.get((key, ext))
+        if data is not None or self.directory is None:
+            return data
+        try:
+            with open(self.path(key, ext), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(key, ext))  # mtime tracks recency for eviction
+        except OSError:
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self._memory.put((key, ext), data)
+        return data
+
+    def put(self, key, ext, data):
+        self._memory.put((key, ext), data)
+        logger.debug("Cached figure %s.%s (%d bytes); cache stats: %s",
+                    key[:12], ext, len(data), self.stats())
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Unique per writer: threads of a process may store the same figure
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key, ext))
+        except OSError as e:
+            logger.warning("Could not write figure %s.%s to disk: %s", key[:12], ext, e)
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files, sum(size for _, size, _ in files)
+
+    def _evict_disk(self):
+        # Other processes write here too, so start from the directory listing
+        files, self._disk_bytes = self._scan_disk()
+        for _, size, path in sorted(files):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+
+    def stats(self):
+        stats = self._memory.stats()
+        with self._lock:
+            stats['disk_hits'] = self.disk_hits
+        # Memory misses that were found on disk count as hits overall
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+figure_cache = FigureCache(max_bytes=FIGURE_CACHE_MB * 1024 ** 2,
+                           directory=FIGURE_CACHE_DIR,
+                           max_disk_bytes=FIGURE_DISK_CACHE_MB * 1024 ** 2)
+
+
+def register_figure_routes(server, url_base_pathname='/'):
+    """Serve cached figures from the Flask ``server``.
+
+    ``GET <base>_figures/<key>.<ext>`` returns the entry stored by the figure
+    callbacks under ``figure_key``, with an ETag of its content and a
+    Cache-Control header, so browsers and proxies cache the image and
+    repeated requests are answered with 304 Not Modified. Nothing is
+    rendered here: entries not in the cache are answered with 404.
+    """
+    from flask import Response, abort, request
+
+    def serve_figure(key, ext):
+        if not _FIGURE_KEY.match(key) or ext not in FIGURE_MIMETYPES:
+            abort(404)
+        data = figure_cache.get(key, ext)
+        if data is None:
+            abort(404)
+        response = Response(data, mimetype=FIGURE_MIMETYPES[ext])
+        response.set_etag(hashlib.sha256(data).hexdigest())
+        response.cache_control.public = True
+        response.cache_control.max_age = FIGURE_MAX_AGE
+        return response.make_conditional(request)
+
+    server.add_url_rule(f'{url_base_pathname}_figures/<key>.<ext>',
+                        'annofig_figure', serve_figure, methods=['GET'])
@@ -0,0 +1,156 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Table formats by file extension; a trailing '.gz' marks gzip compressed text
+FORMATS = {'.csv': 'csv', '.tsv': 'tsv', '.txt': 'tsv', '.tab': 'tsv',
+           '.xls': 'excel', '.xlsx': 'excel',
+           '.parquet': 'parquet', '.pq': 'parquet',
+           '.feather': 'feather', '.arrow': 'feather'}
+SUPPORTED_EXTENSIONS = tuple(FORMATS) + tuple(ext + '.gz' for ext, fmt in FORMATS.items()
+                                              if fmt in ('csv', 'tsv'))
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORICAL_RATIO = 0.5
+
+_FLOAT32 = np.finfo(np.float32)
+
+
+def table_format(filename):
+    """Return ``(format, compression)`` of a file from its name.
+
+    Raises ``ValueError`` for unsupported extensions.
+    """
+    name = (filename or '').lower()
+    compression = None
+    if name.endswith('.gz'):
+        name, compression = name[:-3], 'gzip'
+    for ext, fmt in FORMATS.items():
+        if name.endswith(ext) and (compression is None or fmt in ('csv', 'tsv')):
+            return fmt, compression
+    raise ValueError(f"Unsupported file format: {filename}")
+
+
+def is_supported(filename):
+    try:
+        table_format(filename)
+    except ValueError:
+        return False
+    return True
+
+
+def read_columns(source, filename):
+    """Return the column names of a table without loading its rows."""
+    fmt, compression = table_format(filename)
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(source).names
+    if fmt == 'feather':
+        import pyarrow.ipc
+        return pyarrow.ipc.open_file(source).schema.names
+    if fmt == 'excel':
+        return pd.read_excel(source, sheet_name=0, nrows=0).columns.tolist()
+    return pd.read_csv(source, sep='\t' if fmt == 'tsv' else ',',
+                       compression=compression, nrows=0).columns.tolist()
+
+
+def _unique_columns(columns):
+    """Return ``columns`` as a list without repeats, or ``None``.
+
+    The same column may be requested for several roles (e.g. ``padj`` as
+    both y and annotate column), which readers reject or load twice.
+    """
+    return list(dict.fromkeys(columns)) if columns is not None else None
+
+
+def read_table(source, filename, columns=None):
+    """Read a table from a path or buffer, by the extension of ``filename``.
+
+    Only ``columns`` are loaded when given, each once. Text files are parsed
+    with the multithreaded pyarrow engine when pyarrow is installed. The
+    result is made compact with ``compact_frame``.
+    """
+    fmt, compression = table_format(filename)
+    columns = _unique_columns(columns)
+    if fmt == 'parquet':
+        df = pd.read_parquet(source, columns=columns)
+    elif fmt == 'feather':
+        df = pd.read_feather(source, columns=columns)
+    elif fmt == 'excel':
+        df = pd.read_excel(source, sheet_name=0, usecols=columns)
+    else:
+        df = pd.read_csv(source, sep='\t' if fmt == 'tsv' else ',',
+                         compression=compression, usecols=columns,
+                         engine='pyarrow' if HAS_PYARROW else 'c')
+    if columns is not None:
+        df = df[columns]
+    return compact_frame(df)
+
+
+def compact_frame(df):
+    """Shrink the dtypes of ``df`` without changing what gets plotted.
+
+    Float columns become float32 unless a value would overflow or a non-zero
+    value would underflow (e.g. adjusted p-values below 1e-38, which matter on
+    log axes). Integer columns get the smallest integer type. Repetitive text
+    columns become categoricals.
+    """
+    compacted = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_float_dtype(values.dtype) and values.dtype != np.float32:
+            magnitude = np.abs(values.to_numpy(dtype=float))
+            magnitude = magnitude[np.isfinite(magnitude) & (magnitude > 0)]
+            if not magnitude.size or (magnitude.min() >= _FLOAT32.tiny
+                                      and magnitude.max() <= _FLOAT32.max):
+                values = values.astype(np.float32)
+        elif pd.api.types.is_integer_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            values = pd.to_numeric(values, downcast='integer')
+        elif (pd.api.types.is_object_dtype(values.dtype)
+              or pd.api.types.is_string_dtype(values.dtype)):
+            if len(values) and values.nunique() <= CATEGORICAL_RATIO * len(values):
+                values = values.astype('category')
+        compacted[col] = values
+    return pd.DataFrame(compacted, index=df.index)
+
+
+def write_arrow(df, path):
+    """Write ``df`` to ``path`` as an uncompressed Arrow (Feather) file.
+
+    Uncompressed files can be memory-mapped by ``read_arrow``. Categoricals
+    are written as plain strings, since a mapped file is shared between
+    processes anyway.
+    """
+    import pyarrow
+    import pyarrow.feather
+    categorical = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    table = pyarrow.Table.from_pandas(df.astype({col: object for col in categorical}),
+                                      preserve_index=False)
+    # A unique temporary file per writer, renamed into place once complete
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    try:
+        pyarrow.feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_arrow(path, columns=None):
+    """Memory-map an Arrow file written by ``write_arrow`` as a DataFrame.
+
+    Columns are pyarrow-backed (``pd.ArrowDtype``) views of the mapped file,
+    so the data is not copied and its pages are shared by all processes
+    reading the same file.
+    """
+    import pyarrow.feather
+    table = pyarrow.feather.read_table(path, columns=_unique_columns(columns), memory_map=True)
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
@@ -0,0 +1,362 @@
+"""Opt-in timing of callbacks and pipeline stages.
+
+Enabled with ``ANNOFIG_METRICS=1``. Stages of the pipeline are wrapped in
+``stage()``, callbacks in ``instrument_callback``. Every process (web
+workers and background render processes alike) keeps its own totals and
+writes them to ``ANNOFIG_METRICS_DIR`` after each callback; the metrics
+endpoint adds up the files of all processes. With ``ANNOFIG_METRICS_LOG=1``
+every callback also logs one JSON line with its stages.
+"""
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get('ANNOFIG_METRICS', '0') == '1'
+METRICS_LOG = os.environ.get('ANNOFIG_METRICS_LOG', '0') == '1'
+METRICS_DIR = os.environ.get('ANNOFIG_METRICS_DIR',
+                             os.path.join(tempfile.gettempdir(), 'annofig-metrics'))
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Optional sizes recorded with a stage, exported as counters
+FIELDS = ('rows', 'labels', 'bytes')
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+# Lines of the tracemalloc report written for a profiled callback
+TRACEMALLOC_TOP = 50
+# A compaction lock older than this (in seconds) is considered abandoned
+_STALE_LOCK = 60
+
+_lock = threading.Lock()
+# Serializes flushes, so the file of a process ends with its latest totals
+_flush_lock = threading.Lock()
+_series = {}  # 'kind|name' -> totals, see _record
+_local = threading.local()
+_process_file = None
+
+
+def _reset_after_fork():
+    # A forked process (e.g. a background render) reports only its own work
+    global _lock, _flush_lock, _series, _process_file
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _series = {}
+    _process_file = None
+    _local.__dict__.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _new_totals():
+    return {'count': 0, 'errors': 0, 'seconds': 0.0, 'buckets': [0] * len(BUCKETS),
+            **{field: 0 for field in FIELDS}}
+
+
+def _record(kind, name, seconds, fields, error=False):
+    with _lock:
+        totals = _series.setdefault(f'{kind}|{name}', _new_totals())
+        totals['count'] += 1
+        totals['errors'] += int(error)
+        totals['seconds'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                totals['buckets'][i] += 1
+        for field in FIELDS:
+            totals[field] += int(fields.get(field) or 0)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None and kind == 'stage':
+        trace.append({'stage': name, 'seconds': round(seconds, 6),
+                      **{field: fields[field] for field in FIELDS if field in fields}})
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Time the enclosed block as the pipeline stage ``name``.
+
+    Yields a dict of the sizes to record with it (``rows``, ``labels``,
+    ``bytes``), which the block may fill in. Does nothing unless metrics
+    are enabled.
+    """
+    if not METRICS_ENABLED:
+        yield fields
+        return
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        _record('stage', name, time.perf_counter() - start, fields)
+
+
+def instrument_callback(func):
+    """Record the wall time and stages of every call of a Dash callback.
+
+    Raising ``PreventUpdate`` does not count as an error. A call is run
+    under cProfile or tracemalloc when a profile was armed with
+    ``arm_profile``.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return func(*args, **kwargs)
+        _local.trace = []
+        error = False
+        start = time.perf_counter()
+        try:
+            mode = _claim_profile(name)
+            if mode:
+                return _run_profiled(mode, name, func, args, kwargs)
+            return func(*args, **kwargs)
+        except Exception as e:
+            from dash.exceptions import PreventUpdate
+            error = not isinstance(e, PreventUpdate)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            trace, _local.trace = _local.trace, None
+            _record('callback', name, seconds, {}, error)
+            if METRICS_LOG:
+                logger.info(json.dumps({'callback': name, 'seconds': round(seconds, 6),
+                                        'error': error, 'pid': os.getpid(), 'stages': trace}))
+            _flush()
+    return wrapper
+
+
+def arm_profile(mode, callback=None):
+    """Profile the next call of ``callback`` (or of any callback) with ``mode``.
+
+    The request is stored in the metrics directory, so it is picked up by
+    whichever process runs the call. The result is written to
+    ``<metrics dir>/profiles`` and its path logged.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(METRICS_DIR, 'profile.json'), {'mode': mode, 'callback': callback})
+
+
+def _claim_profile(name):
+    path = os.path.join(METRICS_DIR, 'profile.json')
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            request = json.load(f)
+        if request.get('callback') not in (None, '', name):
+            return None
+        # Only one process may take the request
+        claimed = f'{path}.{os.getpid()}'
+        os.rename(path, claimed)
+        os.remove(claimed)
+    except (OSError, ValueError):
+        return None
+    return request['mode']
+
+
+def _run_profiled(mode, name, func, args, kwargs):
+    directory = os.path.join(METRICS_DIR, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.dump_stats(prefix + '.prof')
+            logger.info("Wrote cProfile stats of %s to %s.prof", name, prefix)
+    tracemalloc.start(25)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with open(prefix + '.txt', 'w') as f:
+            f.write(f"Peak traced memory: {peak / 1024 ** 2:.1f} MB\n")
+            for statistic in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                f.write(f"{statistic}\n")
+        logger.info("Wrote tracemalloc report of %s to %s.txt", name, prefix)
+
+
+def _write_json(path, data):
+    # Threads of a process flush concurrently, so each writes its own temp file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def _series_dir():
+    return os.path.join(METRICS_DIR, 'series')
+
+
+def _flush():
+    """Write the totals of this process to the metrics directory."""
+    global _process_file
+    if _process_file is None:
+        _process_file = os.path.join(_series_dir(), f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+    with _flush_lock:
+        with _lock:
+            series = json.loads(json.dumps(_series))
+        try:
+            os.makedirs(_series_dir(), exist_ok=True)
+            _write_json(_process_file, series)
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %s", _process_file, e)
+
+
+def _merge(into, series):
+    for key, totals in series.items():
+        merged = into.setdefault(key, _new_totals())
+        for field, value in totals.items():
+            if field == 'buckets':
+                merged[field] = [a + b for a, b in zip(merged[field], value)]
+            else:
+                merged[field] += value
+    return into
+
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _compact(directory):
+    # Fold the files of finished processes (one per background render) into
+    # a single file, so that the directory does not grow without bounds
+    lock_path = os.path.join(directory, 'compact.lock')
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > _STALE_LOCK:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        return
+    os.close(fd)
+    try:
+        retired_path = os.path.join(directory, 'retired.json')
+        retired = _read_series(retired_path)
+        finished = []
+        for entry in os.scandir(directory):
+            pid = entry.name.split('-', 1)[0]
+            if entry.name.endswith('.json') and pid.isdigit() and not _process_alive(int(pid)):
+                _merge(retired, _read_series(entry.path))
+                finished.append(entry.path)
+        if finished:
+            _write_json(retired_path, retired)
+            for path in finished:
+                os.remove(path)
+    finally:
+        os.remove(lock_path)
+
+
+def _read_series(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def collect():
+    """Return the totals of all processes, keyed by ``'kind|name'``."""
+    _flush()
+    directory = _series_dir()
+    _compact(directory)
+    series = {}
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.json'):
+            _merge(series, _read_series(entry.path))
+    return series
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(series, gauges=None):
+    """Format ``collect()`` totals (and ``gauges``) in the Prometheus text format.
+
+    ``gauges`` maps a cache name to a callable returning a dict of numbers,
+    e.g. ``DatasetStore.stats``; they describe the serving process only.
+    """
+    lines = []
+    for kind, label in (('callback', 'callback'), ('stage', 'stage')):
+        metric = f'annofig_{kind}_seconds'
+        lines += [f'# HELP {metric} Wall time of {kind}s.', f'# TYPE {metric} histogram']
+        items = sorted((key.split('|', 1)[1], totals) for key, totals in series.items()
+                       if key.startswith(kind + '|'))
+        for name, totals in items:
+            labels = f'{label}="{_escape(name)}"'
+            for bound, count in zip(BUCKETS, totals['buckets']):
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {totals["count"]}')
+            lines.append(f'{metric}_sum{{{labels}}} {totals["seconds"]}')
+            lines.append(f'{metric}_count{{{labels}}} {totals["count"]}')
+        counters = ['errors'] if kind == 'callback' else list(FIELDS)
+        for field in counters:
+            metric_total = f'annofig_{kind}_{field}_total'
+            lines += [f'# HELP {metric_total} Total {field} of {kind}s.',
+                      f'# TYPE {metric_total} counter']
+            lines += [f'{metric_total}{{{label}="{_escape(name)}"}} {totals[field]}'
+                      for name, totals in items]
+    for cache, stats in (gauges or {}).items():
+        for field, value in sorted(stats().items()):
+            if isinstance(value, (int, float)):
+                metric = f'annofig_cache_{field}'
+                lines.append(f'{metric}{{cache="{_escape(cache)}",pid="{os.getpid()}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def register_metrics_routes(server, url_base_pathname='/', gauges=None):
+    """Add the metrics endpoints to the Flask ``server`` if metrics are enabled.
+
+    ``GET <base>_metrics`` returns all metrics in the Prometheus text format.
+    ``POST <base>_metrics/profile`` with ``{"mode": "cprofile"|"tracemalloc",
+    "callback": <optional callback name>}`` profiles the next matching call.
+    """
+    if not METRICS_ENABLED:
+        return
+    from flask import Response, jsonify, request
+
+    def metrics():
+        return Response(prometheus_text(collect(), gauges),
+                        mimetype='text/plain; version=0.0.4')
+
+    def profile():
+        options = request.get_json(silent=True) or request.values
+        try:
+            arm_profile(options.get('mode', 'cprofile'), options.get('callback'))
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        return jsonify(armed=True)
+
+    server.add_url_rule(f'{url_base_pathname}_metrics', 'annofig_metrics', metrics,
+                        methods=['GET'])
+    server.add_url_rule(f'{url_base_pathname}_metrics/profile', 'annofig_metrics_profile',
+                        profile, methods=['POST'])
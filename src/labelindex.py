@@ -0,0 +1,82 @@
+import bisect
+
+import numpy as np
+import pandas as pd
+
+# Entered names ending with this character match every label with that prefix
+PREFIX_WILDCARD = '*'
+# Rough per-label overhead of the index (dict slot, list slot, string header)
+_LABEL_OVERHEAD = 160
+
+
+class LabelIndex:
+    """Case-insensitive lookup of the labels of one column.
+
+    Exact lookups go through a hash map from casefolded names to labels.
+    Prefix lookups (autocompletion, ``NAME*`` patterns) bisect a sorted
+    array of the casefolded names, which answers the same queries as a
+    prefix trie with a fraction of its memory. Labels keep their original
+    values and types, so matches can be compared with the column directly.
+    Labels only differing in case (e.g. mouse ``Myc`` next to human ``MYC``)
+    are all returned for the shared name.
+    """
+
+    def __init__(self, labels):
+        values = pd.unique(pd.Series(labels).dropna().to_numpy(dtype=object))
+        keys = pd.Series(values, dtype=object).astype(str).str.casefold()
+        self._exact = dict(zip(keys.tolist(), values.tolist()))
+        self._variants = {}
+        clashes = keys.duplicated(keep=False).to_numpy()
+        for key, value in zip(keys[clashes].tolist(), values[clashes].tolist()):
+            self._variants.setdefault(key, []).append(value)
+        self._keys = sorted(self._exact)
+        self.nbytes = int(keys.str.len().sum()) * 2 + _LABEL_OVERHEAD * len(values)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _labels(self, key):
+        variants = self._variants.get(key)
+        return variants if variants is not None else [self._exact[key]]
+
+    def _prefix_range(self, prefix):
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self._keys, prefix)
+        stop = bisect.bisect_left(self._keys, prefix + '\U0010ffff', lo=start)
+        return start, stop
+
+    def lookup(self, name):
+        """Return the labels equal to ``name`` ignoring case (possibly none)."""
+        key = str(name).casefold()
+        return self._labels(key) if key in self._exact else []
+
+    def complete(self, prefix, limit=20):
+        """Return up to ``limit`` labels starting with ``prefix``, in sorted order."""
+        start, stop = self._prefix_range(prefix)
+        completions = []
+        for key in self._keys[start:min(stop, start + limit)]:
+            completions.extend(self._labels(key))
+        return completions[:limit]
+
+    def match(self, names):
+        """Resolve entered names to labels.
+
+        Names match case-insensitively; a name ending with ``*`` matches all
+        labels with that prefix. Returns ``(labels, unmatched)``: the matched
+        labels without duplicates, and the names that matched nothing in the
+        order they were given.
+        """
+        matched, unmatched = [], []
+        for name in names:
+            if name.endswith(PREFIX_WILDCARD) and len(name) > 1:
+                start, stop = self._prefix_range(name[:-1])
+                found = [label for key in self._keys[start:stop] for label in self._labels(key)]
+            else:
+                found = self.lookup(name)
+            if found:
+                matched.extend(found)
+            else:
+                unmatched.append(name)
+        if not matched:
+            return [], unmatched
+        return pd.unique(np.array(matched, dtype=object)).tolist(), unmatched
@@ -0,0 +1,215 @@
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Default budgets for the label placement of the static figure: the most
+# labels searched for a free spot, and the seconds the search may take
+LABEL_MAX_ITER = int(os.environ.get('ANNOFIG_LABEL_MAX_ITER', 1000))
+LABEL_TIME_BUDGET = float(os.environ.get('ANNOFIG_LABEL_TIME_BUDGET', 2.0))
+
+# Occupancy raster resolution: cells per label height, and at most this many
+# cells along each side of the axes
+RASTER_CELLS_PER_LINE = 4
+RASTER_MAX_CELLS = 256
+# Labels are first searched for within this many label widths and heights
+# of their default spot
+SEARCH_WINDOW = (2, 4)
+# Weight of the distance from the default spot (centred above the point)
+# when choosing among free spots; it breaks ties towards that spot
+CENTRE_WEIGHT = 0.25
+
+LabelReport = namedtuple('LabelReport', ['placed', 'overlapping', 'dropped', 'iterations', 'seconds'])
+
+
+def _text_sizes(texts, renderer):
+    """Return the width and height in pixels of every text.
+
+    Measuring each text through matplotlib's layout engine costs about a
+    millisecond, so glyph widths are measured once per character and font
+    and summed (ignoring kerning, which only makes boxes slightly larger).
+    """
+    glyphs = {}
+    heights = {}
+    w = np.empty(len(texts))
+    h = np.empty(len(texts))
+    for k, text in enumerate(texts):
+        prop = text.get_fontproperties()
+        font = hash(prop)
+        if font not in heights:
+            _, height, _ = renderer.get_text_width_height_descent('Ag', prop, ismath=False)
+            heights[font] = height
+        width = 0.0
+        for char in text.get_text():
+            key = (font, char)
+            if key not in glyphs:
+                glyphs[key] = renderer.get_text_width_height_descent(char, prop, ismath=False)[0]
+            width += glyphs[key]
+        w[k] = width
+        h[k] = heights[font]
+    return w, h
+
+
+def _summed_area(raster):
+    """Return the summed-area table of ``raster``, with a leading zero row and column."""
+    table = np.zeros((raster.shape[0] + 1, raster.shape[1] + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(raster, axis=0, dtype=np.int32), axis=1, out=table[1:, 1:])
+    return table
+
+
+def _box_sums(table, width, height):
+    """Return the sums of all ``width`` x ``height`` boxes of a summed-area table."""
+    return (table[width:, height:] - table[:-width, height:]
+            - table[width:, :-height] + table[:-width, :-height])
+
+
+def place_labels(ax, texts, anchors_x, anchors_y, priorities=None, required=None,
+                 force_text=0.3, force_points=0.4,
+                 max_iter=LABEL_MAX_ITER, time_budget=LABEL_TIME_BUDGET,
+                 overflow='drop', line_color='gray', line_width=0.5):
+    """Move ``texts`` so they neither overlap each other nor their points.
+
+    Labels are placed one by one in priority order (lower value in
+    ``priorities`` first), each at the free spot nearest to its point. Free
+    space is tracked in an occupancy raster of the axes: summed-area tables
+    of the placed labels and of the points test every position of a label
+    at once. The neighbourhood of the point is searched first and the whole
+    axes only when it is full, so a label that fits anywhere is placed. A
+    label that fits nowhere stays at its default spot above its point,
+    overlapping other labels. ``force_text`` and ``force_points`` set the
+    spacing kept from other labels and from points. Labels away from their
+    point get a leader line to it.
+
+    At most ``max_iter`` labels are searched for, within ``time_budget``
+    seconds. Labels left over are removed, or greyed out above their point
+    with ``overflow='grey'``, except those marked in the boolean mask
+    ``required``: they are searched for first and never removed.
+
+    Returns a ``LabelReport`` with the number of placed, overlapping and
+    dropped labels and of labels searched for.
+    """
+    start = time.perf_counter()
+    deadline = start + time_budget
+    n = len(texts)
+    if n == 0:
+        return LabelReport(0, 0, 0, 0, 0.0)
+    if priorities is None:
+        priorities = np.arange(n)
+    required = np.zeros(n, dtype=bool) if required is None else np.asarray(required, dtype=bool)
+    order = np.lexsort((np.asarray(priorities), ~required))
+
+    renderer = ax.get_figure().canvas.get_renderer()
+    anchors = ax.transData.transform(np.column_stack([anchors_x, anchors_y]).astype(float))
+    px, py = anchors[:, 0], anchors[:, 1]
+    w, h = _text_sizes(texts, renderer)
+    # Stronger repelling keeps labels further apart
+    pad = max(force_text, 0.1) * 0.5 * np.median(h)
+    point_pad = max(force_points, 0.1) * 0.5 * np.median(h)
+    bounds = ax.get_window_extent(renderer)
+
+    # Raster cells of ``size`` pixels over the axes. Every label reserves the
+    # cells covering its box grown by half the padding, so reserved boxes
+    # that share no cell keep labels ``pad`` apart; boxes are rounded out to
+    # whole cells, which only ever adds space.
+    size = max(np.median(h) / RASTER_CELLS_PER_LINE,
+               max(bounds.width, bounds.height) / RASTER_MAX_CELLS, 1e-6)
+    nx, ny = int(bounds.width // size), int(bounds.height // size)
+    labels_raster = np.zeros((nx, ny), dtype=np.int32)
+    # Points are kept on a raster with a margin of ``margin`` cells, so boxes
+    # grown by the point spacing can be tested up to the axes edges
+    margin = int(np.ceil(max(point_pad - pad / 2, 0) / size))
+    points_raster = np.zeros((nx + 2 * margin, ny + 2 * margin), dtype=np.int32)
+    gx = np.floor((px - bounds.x0) / size).astype(np.int64)
+    gy = np.floor((py - bounds.y0) / size).astype(np.int64)
+    visible = (gx >= 0) & (gx < nx) & (gy >= 0) & (gy < ny)
+    np.add.at(points_raster, (gx[visible] + margin, gy[visible] + margin), 1)
+    points_table = _summed_area(points_raster)
+
+    def nearest_free(k, bw, bh, i0, i1, j0, j1):
+        """Return the free box start ``(i, j)`` in a window nearest to label k, or None."""
+        sums = _box_sums(_summed_area(labels_raster[i0:i1 + bw - 1, j0:j1 + bh - 1]), bw, bh)
+        free_i, free_j = np.nonzero((sums == 0) & points_free[bw, bh][i0:i1, j0:j1])
+        if not len(free_i):
+            return None
+        # Nearest free box: distance from the point to the label, then from
+        # the label centre to the default spot right above the point
+        x = bounds.x0 + (free_i + i0 + bw / 2) * size
+        y = bounds.y0 + (free_j + j0 + bh / 2) * size
+        dx, dy = np.abs(x - px[k]), np.abs(y - py[k])
+        gap = np.hypot(np.maximum(dx - w[k] / 2, 0), np.maximum(dy - h[k] / 2, 0))
+        best = np.argmin(gap + CENTRE_WEIGHT * np.hypot(dx, y - cy[k]))
+        return free_i[best] + i0, free_j[best] + j0
+
+    cx, cy = px.copy(), py + h / 2 + pad
+    placed = np.zeros(n, dtype=bool)
+    # Labels searched for that fit nowhere, left at their default spot
+    overlapping = np.zeros(n, dtype=bool)
+    points_free = {}
+    # Box sizes that fit nowhere; the raster only fills up, so no box at
+    # least as large will fit later either
+    failed = []
+    iterations = 0
+    for k in order.tolist():
+        if iterations >= max_iter or time.perf_counter() > deadline:
+            break
+        iterations += 1
+        bw = int(np.ceil((w[k] + pad) / size))
+        bh = int(np.ceil((h[k] + pad) / size))
+        if bw > nx or bh > ny or any(bw >= fw and bh >= fh for fw, fh in failed):
+            overlapping[k] = True
+            continue
+        if (bw, bh) not in points_free:
+            # Box starts (i, j) at which the box keeps clear of all points
+            points_free[bw, bh] = _box_sums(points_table, bw + 2 * margin, bh + 2 * margin) == 0
+        # Search the neighbourhood of the default spot first, and the whole
+        # axes only when nothing is free there
+        i = int(np.clip((cx[k] - bounds.x0) / size - bw / 2, 0, nx - bw))
+        j = int(np.clip((cy[k] - bounds.y0) / size - bh / 2, 0, ny - bh))
+        reach_i, reach_j = SEARCH_WINDOW[0] * bw, SEARCH_WINDOW[1] * bh
+        spot = nearest_free(k, bw, bh, max(i - reach_i, 0), min(i + reach_i, nx - bw) + 1,
+                            max(j - reach_j, 0), min(j + reach_j, ny - bh) + 1)
+        if spot is None:
+            spot = nearest_free(k, bw, bh, 0, nx - bw + 1, 0, ny - bh + 1)
+        if spot is None:
+            failed.append((bw, bh))
+            overlapping[k] = True
+            continue
+        i, j = spot
+        labels_raster[i:i + bw, j:j + bh] = 1
+        cx[k] = bounds.x0 + (i + bw / 2) * size
+        cy[k] = bounds.y0 + (j + bh / 2) * size
+        placed[k] = True
+
+    # Required labels left over by the budget are kept at their default spot
+    overlapping |= required & ~placed
+    shown = placed | overlapping
+    centres = ax.transData.inverted().transform(np.column_stack([cx, cy]))
+    segments = []
+    for k, text in enumerate(texts):
+        if not shown[k] and overflow == 'drop':
+            text.remove()
+            continue
+        text.set_position(centres[k])
+        text.set_horizontalalignment('center')
+        text.set_verticalalignment('center')
+        if not shown[k]:
+            text.set_color('lightgrey')
+            text.set_zorder(text.get_zorder() - 1)
+            continue
+        # Leader line from the point to the closest point of the label box
+        ex = np.clip(px[k], cx[k] - w[k] / 2, cx[k] + w[k] / 2)
+        ey = np.clip(py[k], cy[k] - h[k] / 2, cy[k] + h[k] / 2)
+        if np.hypot(ex - px[k], ey - py[k]) > h[k] / 2:
+            segments.append([(px[k], py[k]), (ex, ey)])
+    if segments:
+        segments = ax.transData.inverted().transform(
+            np.asarray(segments).reshape(-1, 2)).reshape(-1, 2, 2)
+        from matplotlib.collections import LineCollection
+        ax.add_collection(LineCollection(segments, colors=line_color,
+                                         linewidths=line_width, zorder=1.5),
+                          autolim=False)
+
+    placed, overlapping = int(placed.sum()), int(overlapping.sum())
+    return LabelReport(placed, overlapping, n - placed - overlapping, iterations,
+                       time.perf_counter() - start)
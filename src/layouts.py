@@ -1,8 +1,9 @@
-from dash import dcc, html
+from dash import dcc, html, get_asset_url
 import dash_bootstrap_components as dbc
-import base64
 import dash_daq as daq
-from utils import b64_image
+import plotly.io as pio
+
+from utils import plotly_template
 
 
 
@@ -17,7 +18,10 @@ def create_layout(app_title):
                 html.Br(),
                 # Control Panel
                 html.H3("Control Panel"),
-                dcc.Upload(id='upload-data', children=html.Button('Upload CSV file')),
+                dcc.Upload(id='upload-data', children=html.Button('Upload a table (CSV, TSV, Excel, Parquet, Feather)')),
+                html.Button('Upload large file (streamed in chunks)', id='large-upload'),
+                html.Div(id='upload-progress'),
+                dcc.Store(id='dataset-id'),  # ID of the server-side copy of the upload
                 html.Div(id='file-info'),  # Div to display file name and row count
                 html.Div("Select the columns for X axis:"),
                 dcc.Dropdown(id='x-axis', placeholder="Select X axis"),
@@ -45,9 +49,9 @@ def create_layout(app_title):
                 ),
                 html.Div("Change the size of the figures"),
                 html.Div("Width:"),
-                dcc.Input(id='width', type='number', placeholder='Define the width', value=600),
+                dcc.Input(id='width', debounce=True, type='number', placeholder='Define the width', value=600),
                 html.Div("Height:"),
-                dcc.Input(id='height', type='number', placeholder='Define the height', value=600),
+                dcc.Input(id='height', debounce=True, type='number', placeholder='Define the height', value=600),
                 html.Br(),
                 html.Br(),
 
@@ -60,14 +64,17 @@ def create_layout(app_title):
                              placeholder="Select a column to filter (e.g. adjusted p-values)"),
                 html.Div("Filtering data points for annotation"),
                 html.Div("by defining a cutoff:"),
-                dcc.Input(id='annotate-cutoff', type='number',
+                dcc.Input(id='annotate-cutoff', debounce=True, type='number',
                           placeholder='Define a cutoff', value=None),
                 html.Div("or, by their ranking:"),
-                dcc.Input(id='ranking-top-n', type='number', 
+                dcc.Input(id='ranking-top-n', debounce=True, type='number', 
                           placeholder='Top N points', value=0),
                 dcc.Checklist(id='annotate-revert', options=[{'label': 'Revert the ranking of annotated column', 'value': 'annotate-revert'}], inline=False),
-                dcc.Input(id='manual-genes', type='text', 
+                dcc.Input(id='manual-genes', debounce=True, type='text', 
                           placeholder='Enter genes (comma or space separated)'),
+                dcc.Dropdown(id='label-search', options=[],
+                             placeholder="Search a label to add (e.g. TP5)"),
+                html.Div(id='manual-genes-report'),
                 html.Div("Define the color of the annotated data points"),
                 daq.ColorPicker(
                     id='annotation-color',
@@ -84,7 +91,7 @@ def create_layout(app_title):
                     value=dict(hex='#000000')
                 ),
                 html.Div("Control the repelling force for text annotations"),
-                dcc.Input(id='force-text', type='number',
+                dcc.Input(id='force-text', debounce=True, type='number',
                           placeholder='Enter repelling force', value=0.3, step=0.1),
             ], width=4),
 
@@ -94,12 +101,43 @@ def create_layout(app_title):
                 html.H3("Interactive Figure"),
                 html.Div("Labels won't be applied to the interactive figure, because interactive figure is used to explore the data by hovering the data points."),
                 dcc.Graph(id='interactive-figure', style={'width': '600px', 'height': '600px'}),
+                dcc.Store(id='interactive-view'),  # zoomed region, for re-binning large data
+                # Plotly templates of the themes, applied in the browser on theme changes
+                dcc.Store(id='figure-templates',
+                          data={theme: pio.templates[plotly_template(theme)].to_plotly_json()
+                                for theme in ('light', 'dark')}),
+                html.Div("Click, box select or lasso select points to add them to or remove them from the labels of both figures:"),
+                dcc.RadioItems(id='selection-mode', inline=True, value='add',
+                               options=[{'label': 'Add to the labels', 'value': 'add'},
+                                        {'label': 'Remove from the labels', 'value': 'remove'}]),
+                html.Button('Clear selected labels', id='clear-selection'),
+                dcc.Store(id='interactive-selection'),  # selected region, without the points
+                dcc.Store(id='selected-labels', data={'added': [], 'removed': []}),
                 html.Br(),
                 html.H3("Static Figure"),
-                html.Img(id='static-figure',
-                         src=b64_image('./assets/static_figure.png'),
-                         alt='Please define the input data and\nselect both X and Y axes.',
-                         style={'width': '600px', 'height': '600px'})
+                html.Div([dbc.Spinner(size='sm'), " Rendering the static figure..."],
+                         id='static-render-status', style={'display': 'none'}),
+                html.Div(html.Img(id='static-figure',
+                                  src=get_asset_url('static_figure.png'),
+                                  alt='Please define the input data and\nselect both X and Y axes.',
+                                  style={'width': '600px', 'height': '600px'}),
+                         id='static-figure-container'),
+                html.Div(id='label-report'),
+                dcc.Store(id='static-figure-spec'),  # key and settings of the shown figure
+                html.Div(["Download: ",
+                          html.A("PNG", id='download-png', download='annofig.png'), " ",
+                          html.Span([html.Button("SVG", id='download-svg'), " ",
+                                     html.Button("PDF", id='download-pdf')],
+                                    id='download-vector'),
+                          html.Span("preparing the download...", id='download-status',
+                                    style={'display': 'none'}),
+                          dcc.Download(id='download-file')]),
+                html.Div("Background points of the static figure:"),
+                dcc.Dropdown(id='static-background', value='auto', clearable=False,
+                             options=[{'label': 'Automatic (rasterized for large data)', 'value': 'auto'},
+                                      {'label': 'Vector points', 'value': 'points'},
+                                      {'label': 'Rasterized points', 'value': 'raster'},
+                                      {'label': 'Hexagonal density bins', 'value': 'hexbin'}])
             ], width=8)
         ])
     ])
@@ -110,7 +148,7 @@ def create_banner(app_title):
         [
             dbc.Row(
                 [
-                    dbc.Col(html.Img(src=b64_image('./assets/plotly_logo.png'),
+                    dbc.Col(html.Img(src=get_asset_url('plotly_logo.png'),
                                      style={'height': '40px'}), width=10),
                     dbc.Col(html.A(
                         id='gh-link',
@@ -0,0 +1,178 @@
+import numpy as np
+
+from utils import clamp_non_positive
+
+# Average number of points per grid cell
+POINTS_PER_CELL = 16
+
+
+def axis_units(values, log):
+    """Convert data values to axis units: log10 on log axes, as plotted."""
+    values = np.asarray(values, dtype=float)
+    if not log:
+        return values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log10(clamp_non_positive(values))
+
+
+def _concat_ranges(starts, stops):
+    """Return the concatenation of ``arange(start, stop)`` for all pairs."""
+    counts = stops - starts
+    total = int(counts.sum())
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(total)
+
+
+def points_in_polygon(x, y, poly_x, poly_y):
+    """Even-odd test of the points ``(x, y)`` against a closed polygon.
+
+    Points are sorted by y, so every edge only tests the slice of points
+    within its y-span instead of all of them.
+    """
+    order = np.argsort(y, kind='stable')
+    xs, ys = np.asarray(x)[order], np.asarray(y)[order]
+    inside = np.zeros(len(xs), dtype=bool)
+    xj, yj = poly_x[-1], poly_y[-1]
+    for xi, yi in zip(poly_x, poly_y):
+        if yi != yj:
+            # The edge crosses the horizontal ray of points with low <= y < high
+            start, stop = np.searchsorted(ys, sorted((yi, yj)))
+            span = slice(start, stop)
+            inside[span] ^= xs[span] < (xj - xi) * (ys[span] - yi) / (yj - yi) + xi
+        xj, yj = xi, yi
+    result = np.empty_like(inside)
+    result[order] = inside
+    return result
+
+
+class PointIndex:
+    """Uniform grid index over the plotted positions of a table's rows.
+
+    Positions are taken in axis units (log10 of the data on log axes, with
+    non-positive values clamped like the figures do) and scaled to the unit
+    square. Points are bucketed into a square grid stored CSR-style: the
+    points sorted by cell, cell-major along x, plus the start offset of
+    every cell. The cells of a column are contiguous, so a box query reads
+    one slice per grid column. Queries take axis units, like the ranges and
+    lasso points of Plotly selection events, and return row positions.
+    """
+
+    def __init__(self, x, y, x_log=False, y_log=False):
+        self.x_log, self.y_log = x_log, y_log
+        tx, ty = axis_units(x, x_log), axis_units(y, y_log)
+        finite = np.isfinite(tx) & np.isfinite(ty)
+        rows = np.flatnonzero(finite)
+        tx, ty = tx[finite], ty[finite]
+        self._origin, self._span = [], []
+        for values in (tx, ty):
+            low = values.min() if len(values) else 0.0
+            high = values.max() if len(values) else 1.0
+            self._origin.append(low)
+            self._span.append(high - low if high > low else 1.0)
+        u, v = self._to_unit(tx, ty, transformed=True)
+        self._size = max(1, int(np.sqrt(len(rows) / POINTS_PER_CELL)))
+        cells = self._cell(u) * self._size + self._cell(v)
+        order = np.argsort(cells, kind='stable')
+        self._rows, self._u, self._v = rows[order], u[order], v[order]
+        self._starts = np.searchsorted(cells[order], np.arange(self._size ** 2 + 1))
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nbytes(self):
+        return self._rows.nbytes + self._u.nbytes + self._v.nbytes + self._starts.nbytes
+
+    def _to_unit(self, x, y, transformed=False):
+        if not transformed:
+            x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        return (x - self._origin[0]) / self._span[0], (y - self._origin[1]) / self._span[1]
+
+    def _cell(self, unit):
+        return np.clip((np.asarray(unit) * self._size).astype(np.int64), 0, self._size - 1)
+
+    def _cells_in_rect(self, u_range, v_range):
+        """Return the cell indexes overlapping a rectangle, as ``(gx, gy)`` bounds or None."""
+        if u_range[1] < 0 or u_range[0] > 1 or v_range[1] < 0 or v_range[0] > 1:
+            return None
+        gx0, gx1 = self._cell(u_range)
+        gy0, gy1 = self._cell(v_range)
+        return gx0, gx1, gy0, gy1
+
+    def _rect_positions(self, bounds):
+        gx0, gx1, gy0, gy1 = bounds
+        columns = np.arange(gx0, gx1 + 1) * self._size
+        return _concat_ranges(self._starts[columns + gy0], self._starts[columns + gy1 + 1])
+
+    def _cell_positions(self, cells):
+        return _concat_ranges(self._starts[cells], self._starts[cells + 1])
+
+    def box(self, x_range, y_range):
+        """Return the rows inside the box spanned by two ``[low, high]`` ranges."""
+        (u0, u1), (v0, v1) = (sorted(r) for r in self._to_unit(x_range, y_range))
+        bounds = self._cells_in_rect((u0, u1), (v0, v1))
+        if bounds is None:
+            return np.array([], dtype=np.int64)
+        positions = self._rect_positions(bounds)
+        u, v = self._u[positions], self._v[positions]
+        return self._rows[positions[(u >= u0) & (u <= u1) & (v >= v0) & (v <= v1)]]
+
+    def polygon(self, xs, ys):
+        """Return the rows inside a polygon (e.g. lasso points).
+
+        Only cells crossed by an edge test their points individually; the
+        other cells of the polygon's bounding box are in or out as a whole,
+        decided by their centre.
+        """
+        if len(xs) < 3:
+            return np.array([], dtype=np.int64)
+        pu, pv = self._to_unit(xs, ys)
+        bounds = self._cells_in_rect((pu.min(), pu.max()), (pv.min(), pv.max()))
+        if bounds is None:
+            return np.array([], dtype=np.int64)
+        gx0, gx1, gy0, gy1 = bounds
+        shape = (gx1 - gx0 + 1, gy1 - gy0 + 1)
+        # Cells crossed by an edge: sample every edge at half a cell and mark
+        # the cells next to the samples too, so no crossed cell is missed
+        eu, ev = np.append(pu, pu[0]), np.append(pv, pv[0])
+        steps = np.ceil(np.hypot(np.diff(eu), np.diff(ev)) * self._size * 2).astype(np.int64) + 1
+        edge = np.repeat(np.arange(len(steps)), steps)
+        t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        su = eu[edge] + t * (eu[edge + 1] - eu[edge])
+        sv = ev[edge] + t * (ev[edge + 1] - ev[edge])
+        crossed = np.zeros((shape[0] + 2, shape[1] + 2), dtype=bool)
+        gx = np.clip(np.floor(su * self._size).astype(np.int64) - gx0, -1, shape[0])
+        gy = np.clip(np.floor(sv * self._size).astype(np.int64) - gy0, -1, shape[1])
+        crossed[gx + 1, gy + 1] = True
+        border = np.zeros(shape, dtype=bool)
+        for dx in range(3):
+            for dy in range(3):
+                border |= crossed[dx:dx + shape[0], dy:dy + shape[1]]
+        # The remaining cells are inside or outside as a whole
+        cx, cy = np.meshgrid(np.arange(gx0, gx1 + 1), np.arange(gy0, gy1 + 1), indexing='ij')
+        cells = cx * self._size + cy
+        centres_inside = points_in_polygon((cx[~border] + 0.5) / self._size,
+                                           (cy[~border] + 0.5) / self._size, pu, pv)
+        inside = self._cell_positions(cells[~border][centres_inside])
+        candidates = self._cell_positions(cells[border])
+        hits = points_in_polygon(self._u[candidates], self._v[candidates], pu, pv)
+        return self._rows[np.concatenate([inside, candidates[hits]])]
+
+    def nearest(self, x, y):
+        """Return the row nearest to a position (in unit-square distance), or None."""
+        if not len(self):
+            return None
+        u, v = self._to_unit(x, y)
+        cu, cv = int(self._cell(u)), int(self._cell(v))
+        for radius in range(self._size):
+            bounds = (max(cu - radius, 0), min(cu + radius, self._size - 1),
+                      max(cv - radius, 0), min(cv + radius, self._size - 1))
+            if len(self._rect_positions(bounds)):
+                # A nearer point can still be in the next ring
+                radius += 1
+                bounds = (max(cu - radius, 0), min(cu + radius, self._size - 1),
+                          max(cv - radius, 0), min(cv + radius, self._size - 1))
+                positions = self._rect_positions(bounds)
+                distance = np.hypot(self._u[positions] - u, self._v[positions] - v)
+                return int(self._rows[positions[np.argmin(distance)]])
+        return None
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from cache import register_fork_safe
+
+logger = logging.getLogger(__name__)
+
+# Directory holding uploaded files and how long (in seconds) an unused upload is kept
+SPOOL_DIR = os.environ.get('ANNOFIG_SPOOL_DIR',
+                           os.path.join(tempfile.gettempdir(), 'annofig-spool'))
+SPOOL_TTL = int(os.environ.get('ANNOFIG_SPOOL_TTL', 24 * 3600))
+# Largest body accepted for a single chunk of a streamed upload
+MAX_CHUNK_BYTES = 16 * 1024 ** 2
+# Files kept next to an upload (its metadata, its Arrow copy); removed with it
+DERIVED_SUFFIXES = ('.json', '.arrow')
+
+_DATASET_ID = re.compile(r'^[0-9a-f]{64}$')
+_UPLOAD_ID = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadSpool:
+    """Store uploaded files on disk and hand out content-hash dataset IDs.
+
+    Every upload is written once to ``directory`` as ``<id>.data`` with a
+    ``<id>.json`` sidecar holding the original filename. Callbacks only pass
+    the ID around. Files not accessed for ``ttl`` seconds are removed by
+    ``cleanup``, which runs opportunistically whenever a new upload arrives.
+    Large files can be streamed in chunks with ``append_chunk`` and
+    ``finish`` instead of being sent as one base64 string.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        register_fork_safe(self)
+        os.makedirs(directory, exist_ok=True)
+
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _check_dataset_id(self, dataset_id):
+        if not isinstance(dataset_id, str) or not _DATASET_ID.match(dataset_id):
+            raise UploadError(f"Invalid dataset id: {dataset_id!r}")
+
+    def _part_path(self, upload_id):
+        if not isinstance(upload_id, str) or not _UPLOAD_ID.match(upload_id):
+            raise UploadError(f"Invalid upload id: {upload_id!r}")
+        return self._file(upload_id + '.part')
+
+    def _publish(self, tmp_path, dataset_id, filename):
+        data_path = self._file(dataset_id + '.data')
+        if os.path.exists(data_path):
+            # Same content uploaded before; keep the existing copy
+            os.remove(tmp_path)
+            os.utime(data_path)
+        else:
+            os.replace(tmp_path, data_path)
+        meta = {'filename': os.path.basename(filename or ''),
+                'size': os.path.getsize(data_path)}
+        fd, meta_tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp, self._file(dataset_id + '.json'))
+        logger.info("Stored upload %s (%s, %d bytes)", dataset_id[:12],
+                    meta['filename'], meta['size'])
+        self.maybe_cleanup()
+        return dataset_id
+
+    def save(self, data, filename):
+        """Store ``data`` (bytes) and return its dataset ID."""
+        dataset_id = hashlib.sha256(data).hexdigest()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self._publish(tmp_path, dataset_id, filename)
+
+    def append_chunk(self, upload_id, offset, stream):
+        """Append the chunk read from ``stream`` at byte ``offset``.
+
+        Returns the number of bytes received so far. A chunk whose offset
+        does not match the bytes already received raises ``UploadError``,
+        so clients can resume from the reported size.
+        """
+        part_path = self._part_path(upload_id)
+        received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset != received:
+            raise UploadError(f"Expected offset {received}, got {offset}")
+        written = 0
+        with open(part_path, 'ab') as f:
+            while True:
+                block = stream.read(1024 ** 2)
+                if not block:
+                    break
+                written += len(block)
+                if written > MAX_CHUNK_BYTES:
+                    f.truncate(received)
+                    raise UploadError("Chunk too large")
+                f.write(block)
+        return received + written
+
+    def finish(self, upload_id, filename):
+        """Turn a completed chunked upload into a dataset and return its ID."""
+        part_path = self._part_path(upload_id)
+        if not os.path.exists(part_path):
+            raise UploadError(f"Unknown upload: {upload_id}")
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(block)
+        return self._publish(part_path, digest.hexdigest(), filename)
+
+    def path(self, dataset_id):
+        """Return the path of a stored upload and mark it as recently used."""
+        self._check_dataset_id(dataset_id)
+        data_path = self._file(dataset_id + '.data')
+        os.utime(data_path)  # raises FileNotFoundError once expired
+        return data_path
+
+    def filename(self, dataset_id):
+        self._check_dataset_id(dataset_id)
+        with open(self._file(dataset_id + '.json')) as f:
+            return json.load(f)['filename']
+
+    def derived_path(self, dataset_id, suffix):
+        """Return the path of a file derived from an upload, e.g. ``'.arrow'``."""
+        self._check_dataset_id(dataset_id)
+        if suffix not in DERIVED_SUFFIXES:
+            raise UploadError(f"Unknown derived file: {suffix}")
+        return self._file(dataset_id + suffix)
+
+    def exists(self, dataset_id):
+        try:
+            self._check_dataset_id(dataset_id)
+        except UploadError:
+            return False
+        return os.path.exists(self._file(dataset_id + '.data'))
+
+    def cleanup(self):
+        """Remove uploads and partial uploads unused for longer than the TTL."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = self._file(name)
+            try:
+                suffix = os.path.splitext(name)[1]
+                if suffix in DERIVED_SUFFIXES:
+                    data_path = path[:-len(suffix)] + '.data'
+                    expired = not os.path.exists(data_path)
+                else:
+                    expired = os.path.getmtime(path) < cutoff
+                if expired:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info("Removed %d expired file(s) from %s", removed, self.directory)
+        return removed
+
+    def maybe_cleanup(self):
+        with self._lock:
+            now = time.time()
+            if now - self._last_cleanup < self.ttl / 10:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+
+upload_spool = UploadSpool(SPOOL_DIR, SPOOL_TTL)
+
+
+def register_upload_routes(server, url_base_pathname='/'):
+    """Add the chunked upload endpoints to the Flask ``server``.
+
+    ``POST <base>_upload/<upload_id>`` appends the raw request body at the
+    offset given in the ``X-Upload-Offset`` header, and
+    ``POST <base>_upload/<upload_id>/finish`` with ``{"filename": ...}``
+    returns ``{"dataset_id": ...}`` for use in the ``dataset-id`` store.
+    """
+    from flask import jsonify, request
+
+    def upload_chunk(upload_id):
+        try:
+            offset = int(request.headers.get('X-Upload-Offset', 0))
+            received = upload_spool.append_chunk(upload_id, offset, request.stream)
+        except (UploadError, ValueError) as e:
+            return jsonify(error=str(e)), 409
+        return jsonify(received=received)
+
+    def finish_upload(upload_id):
+        filename = (request.get_json(silent=True) or {}).get('filename', '')
+        try:
+            dataset_id = upload_spool.finish(upload_id, filename)
+        except UploadError as e:
+            return jsonify(error=str(e)), 404
+        return jsonify(dataset_id=dataset_id, filename=os.path.basename(filename))
+
+    server.add_url_rule(f'{url_base_pathname}_upload/<upload_id>',
+                        'annofig_upload_chunk', upload_chunk, methods=['POST'])
+    server.add_url_rule(f'{url_base_pathname}_upload/<upload_id>/finish',
+                        'annofig_upload_finish', finish_upload, methods=['POST'])
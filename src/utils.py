@@ -1,23 +1,34 @@
 import pandas as pd
-import plotly.express as px
-from io import StringIO
+import plotly.graph_objects as go
+from io import BytesIO
 import base64
+import functools
 import math
-import matplotlib
-matplotlib.use('Agg')  # Use a non-GUI backend
-import matplotlib.pyplot as plt
-import seaborn as sns
+import os
+import threading
 import numpy as np
-from adjustText import adjust_text
+from labels import place_labels, LABEL_MAX_ITER, LABEL_TIME_BUDGET
+from instrument import stage
+
+# Above WEBGL_THRESHOLD points the interactive figure switches to WebGL traces,
+# and above DENSITY_THRESHOLD visible background points they are binned into
+# a DENSITY_BINS x DENSITY_BINS density heatmap on the server
+WEBGL_THRESHOLD = int(os.environ.get('ANNOFIG_WEBGL_THRESHOLD', 10000))
+DENSITY_THRESHOLD = int(os.environ.get('ANNOFIG_DENSITY_THRESHOLD', 200000))
+DENSITY_BINS = int(os.environ.get('ANNOFIG_DENSITY_BINS', 200))
+# How the static figure draws background points: 'points' (vector markers),
+# 'raster' (markers in a rasterized layer), 'hexbin' (rasterized hexagonal
+# density bins) or 'auto' ('raster' above STATIC_RASTER_THRESHOLD points)
+STATIC_BACKGROUNDS = ('auto', 'points', 'raster', 'hexbin')
+STATIC_RASTER_THRESHOLD = int(os.environ.get('ANNOFIG_STATIC_RASTER_THRESHOLD', 20000))
 
 
 
       
-def parse_data(contents):
+def decode_contents(contents):
+    """Return the raw bytes of a ``dcc.Upload`` contents string."""
     content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
-    df = pd.read_csv(StringIO(decoded.decode('utf-8')))  # Modify if Excel
-    return df
+    return base64.b64decode(content_string)
 
 def generate_interactive_figure(df, x_col, y_col,
                                 x_log=False, x_revert=False,
@@ -25,48 +36,74 @@ def generate_interactive_figure(df, x_col, y_col,
                                 point_size=10, point_color='blue', theme='light',
                                 label_col=None, annotate_col=None,
                                 top_n=0, annotate_cutoff=None, annotate_revert=False, manual_genes='',
-                                annotation_color='red', annotation_font_size=10, annotation_font_color='black', force_text=0.3):
-    
-    # fig = px.scatter(df, x=x_col, y=y_col, hover_name=label_col)
-    if x_log:
-        min_positive_value = df[df[x_col] > 0][x_col].min()
-        df[x_col] = df[x_col].apply(lambda x: min_positive_value if x <= 0 else x)
-    if y_log:
-        min_positive_value = df[df[y_col] > 0][y_col].min()
-        df[y_col] = df[y_col].apply(lambda x: min_positive_value if x <= 0 else x)
-    if isinstance(point_color, dict) and 'hex' in point_color:
-        point_color = point_color['hex']
-    if isinstance(annotation_color, dict) and 'hex' in annotation_color:
-        annotation_color = annotation_color['hex']
-    if isinstance(annotation_font_color, dict) and 'hex' in annotation_font_color:
-        annotation_font_color = annotation_font_color['hex']
-    
-    sel_labels = get_annotate_labels(df, top_n, annotate_col, label_col,
-                                     annotate_revert, annotate_cutoff,
-                                     manual_genes)
+                                annotation_color='red', annotation_font_size=10, annotation_font_color='black', force_text=0.3,
+                                view=None, excluded_labels=()):
+    """Build the interactive Plotly figure.
+
+    The first trace always holds the background (non-highlighted) points and
+    the second one the highlighted points. Above ``WEBGL_THRESHOLD`` points
+    WebGL traces are used, and above ``DENSITY_THRESHOLD`` background points
+    the background is binned server-side into a density heatmap. ``view``
+    (see ``parse_relayout_view``) restricts the binning to the zoomed region,
+    where individual points come back once few enough are visible.
+    Highlighted points always stay individual, hoverable markers.
+    ``excluded_labels`` are never highlighted, whichever rule selects them.
+    """
+    point_color = normalize_color(point_color)
+    annotation_color = normalize_color(annotation_color)
+    annotation_font_color = normalize_color(annotation_font_color)
     
-    # Add overlay layer for highlighted points with different color and text annotations
-    if sel_labels and label_col:
-        # Separate data into highlighted and non-highlighted
-        highlighted_df = df[df[label_col].isin(sel_labels)]
-        non_highlighted_df = df[~df[label_col].isin(sel_labels)]
-        
-        # Base layer for all points with default color and without text annotations
-        fig = px.scatter(non_highlighted_df, x=x_col, y=y_col, hover_name=label_col)
-        fig.update_traces(marker=dict(size=point_size, color=point_color), text=None)
-        fig.add_scatter(
-            x=highlighted_df[x_col],
-            y=highlighted_df[y_col],
-            mode='markers+text',
-            marker=dict(size=point_size, color=annotation_color),
-            text=highlighted_df[label_col],
-            textposition="top center",
-            textfont=dict(size=annotation_font_size*2, color=annotation_font_color),
-            showlegend=False
-        )
+    with stage('annotate') as info:
+        sel_labels = get_annotate_labels(df, top_n, annotate_col, label_col,
+                                         annotate_revert, annotate_cutoff,
+                                         manual_genes, excluded_labels)
+        info['labels'] = len(sel_labels)
+    with stage('prepare', rows=len(df)):
+        data, highlighted = prepare_plot_data(df, x_col, y_col, x_log, y_log,
+                                              label_col, sel_labels)
+    # Separate data into highlighted and non-highlighted
+    highlighted_df = data[highlighted]
+    non_highlighted_df = data[~highlighted]
+    use_webgl = len(data) > WEBGL_THRESHOLD
+    Scatter = go.Scattergl if use_webgl else go.Scatter
+    hovertemplate = (('<b>%{hovertext}</b><br>' if label_col else '')
+                     + f'{x_col}=%{{x}}<br>{y_col}=%{{y}}<extra></extra>')
+
+    fig = go.Figure()
+    # Base layer for the background points, without text annotations
+    if len(non_highlighted_df) > DENSITY_THRESHOLD:
+        non_highlighted_df = points_in_view(non_highlighted_df, x_col, y_col,
+                                            x_log, y_log, view)
+    if len(non_highlighted_df) > DENSITY_THRESHOLD:
+        x_edges, y_edges, z = density_grid(non_highlighted_df[x_col].to_numpy(),
+                                           non_highlighted_df[y_col].to_numpy(),
+                                           x_log, y_log, view, DENSITY_BINS)
+        fig.add_heatmap(x=x_edges, y=y_edges, z=z,
+                        colorscale=density_colorscale(point_color),
+                        showscale=False, hoverinfo='skip', name='density')
     else:
-        fig = px.scatter(df, x=x_col, y=y_col, hover_name=label_col)
-        fig.update_traces(marker=dict(size=point_size, color=point_color), text=None)
+        fig.add_trace(Scatter(
+            x=non_highlighted_df[x_col],
+            y=non_highlighted_df[y_col],
+            mode='markers',
+            marker=dict(size=point_size, color=point_color),
+            hovertext=non_highlighted_df[label_col] if label_col else None,
+            hovertemplate=hovertemplate,
+            showlegend=False
+        ))
+    # Overlay layer for highlighted points with different color and text annotations
+    fig.add_trace(Scatter(
+        x=highlighted_df[x_col],
+        y=highlighted_df[y_col],
+        mode='markers+text',
+        marker=dict(size=point_size, color=annotation_color),
+        text=highlighted_df[label_col] if label_col else None,
+        hovertext=highlighted_df[label_col] if label_col else None,
+        hovertemplate=hovertemplate,
+        textposition="top center",
+        textfont=dict(size=annotation_font_size*2, color=annotation_font_color),
+        showlegend=False
+    ))
     
     # Apply log scaling if specified
     if x_log:
@@ -81,161 +118,386 @@ def generate_interactive_figure(df, x_col, y_col,
         
     # Apply a clean theme and grid settings
     fig.update_layout(
-        template='simple_white' if theme == 'light' else 'plotly_dark',
-        xaxis=dict(showgrid=False, zeroline=False),
-        yaxis=dict(showgrid=False, zeroline=False),
-        font=dict(size=14)
+        template=plotly_template(theme),
+        xaxis=dict(showgrid=False, zeroline=False, title=x_col),
+        yaxis=dict(showgrid=False, zeroline=False, title=y_col),
+        font=dict(size=14),
+        # Keep the user's zoom across updates until the axes change
+        uirevision=view_signature(x_col, y_col, x_log, y_log, x_revert, y_revert)
     )
     return fig
 
+def plotly_template(theme):
+    """Name of the Plotly template of the interactive figure for a theme."""
+    return 'simple_white' if theme == 'light' else 'plotly_dark'
+
+def view_signature(x_col, y_col, x_log, y_log, x_revert, y_revert):
+    """Identify the axes setup a zoom region (``view``) belongs to."""
+    return f'{x_col}|{y_col}|{bool(x_log)}|{bool(y_log)}|{bool(x_revert)}|{bool(y_revert)}'
+
+def parse_relayout_view(relayout_data, view=None):
+    """Update ``view`` from a ``relayoutData`` event of the interactive figure.
+
+    A view maps 'x' and 'y' to the visible ``[low, high]`` range in axis
+    units (log10 of the data on log axes) or ``None`` when autoscaled.
+    """
+    view = dict(view or {'x': None, 'y': None})
+    for axis in ('x', 'y'):
+        prefix = axis + 'axis.'
+        if relayout_data.get(prefix + 'autorange'):
+            view[axis] = None
+        elif prefix + 'range[0]' in relayout_data and prefix + 'range[1]' in relayout_data:
+            view[axis] = sorted([relayout_data[prefix + 'range[0]'], relayout_data[prefix + 'range[1]']])
+        elif prefix + 'range' in relayout_data:
+            view[axis] = sorted(relayout_data[prefix + 'range'])
+    return view
+
+def _axis_values(values, log):
+    return np.log10(values) if log else values
 
+def points_in_view(data, x_col, y_col, x_log, y_log, view):
+    """Return the rows of ``data`` inside the zoomed region ``view``."""
+    if not view:
+        return data
+    inside = np.ones(len(data), dtype=bool)
+    for col, log, axis in ((x_col, x_log, 'x'), (y_col, y_log, 'y')):
+        if view.get(axis):
+            low, high = view[axis]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = _axis_values(data[col].to_numpy(dtype=float), log)
+            inside &= (values >= low) & (values <= high)
+    return data[inside]
+
+def density_grid(x, y, x_log, y_log, view, bins):
+    """Bin points into a ``bins`` x ``bins`` grid over the visible region.
+
+    Bins are uniform in axis units, so they are log-spaced on log axes.
+    Returns the bin edges in data units and log-scaled counts, with empty
+    bins set to NaN so they stay transparent.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tx = _axis_values(np.asarray(x, dtype=float), x_log)
+        ty = _axis_values(np.asarray(y, dtype=float), y_log)
+    finite = np.isfinite(tx) & np.isfinite(ty)
+    tx, ty = tx[finite], ty[finite]
+    ranges = []
+    for values, axis in ((tx, 'x'), (ty, 'y')):
+        if view and view.get(axis):
+            ranges.append(view[axis])
+        elif len(values):
+            ranges.append([values.min(), values.max() if values.max() > values.min() else values.min() + 1])
+        else:
+            ranges.append([0, 1])
+    counts, x_edges, y_edges = np.histogram2d(tx, ty, bins=bins, range=ranges)
+    z = np.log1p(counts.T).round(2)
+    z[counts.T == 0] = np.nan
+    if x_log:
+        x_edges = 10 ** x_edges
+    if y_log:
+        y_edges = 10 ** y_edges
+    return x_edges, y_edges, z
+
+def density_colorscale(color):
+    """Colorscale fading from a translucent to the opaque point color."""
+    if isinstance(color, str) and color.startswith('#') and len(color) == 7:
+        r, g, b = (int(color[i:i + 2], 16) for i in (1, 3, 5))
+        return [[0, f'rgba({r},{g},{b},0.25)'], [1, f'rgba({r},{g},{b},1)']]
+    return [[0, color], [1, color]]
+
+
+# Matplotlib's text layout (mathtext parser, font cache) is not thread-safe, so
+# renders within one process are serialized; separate processes run in parallel.
+_mpl_lock = threading.Lock()
+
+
+def _reset_mpl_lock():
+    # A child forked while another thread rendered would wait for it forever
+    global _mpl_lock
+    _mpl_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_mpl_lock)
+
+def with_mpl_lock(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _mpl_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+@with_mpl_lock
 def generate_static_figure(df, x_col, y_col, x_log=False, x_revert=False, y_log=False, y_revert=False, 
                            point_size=10, point_color='blue', theme='light',  width=600, height=600,
                            label_col=None, annotate_col=None,
                            top_n=0, annotate_cutoff=None, annotate_revert=False, manual_genes='',
-                           annotation_color='red', annotation_font_size=10, annotation_font_color='black', force_text=0.3, dpi=300):
+                           annotation_color='red', annotation_font_size=10, annotation_font_color='black', force_text=0.3, dpi=300,
+                           label_max_iter=LABEL_MAX_ITER, label_time_budget=LABEL_TIME_BUDGET, label_overflow='drop',
+                           excluded_labels=(), background_mode='auto', fmt='png', return_report=False):
+    """Render the static figure and return the image bytes.
+
+    matplotlib and seaborn are imported on the first call, so that serving
+    the interactive figure never loads them.
+
+    ``excluded_labels`` are never annotated, whichever rule selects them.
+    ``background_mode`` is one of ``STATIC_BACKGROUNDS``; rasterized backgrounds
+    keep SVG and PDF files small for any number of points, while highlighted
+    points, labels and axes stay vector.
+    ``fmt`` is any format matplotlib can save to, e.g. 'png', 'svg' or 'pdf'.
+    With ``return_report`` a ``(image_bytes, LabelReport)`` tuple is returned
+    instead, reporting how many labels were placed and dropped.
+    """
+    sns = import_seaborn()
     extra_size = 1.2
+    report = None
+    figsize = ((width/dpi)*extra_size, (height/dpi)*extra_size)
     # Check if input data or necessary columns are missing, create a placeholder if so
     if df is None or df.empty or x_col is None or y_col is None:
-        fig, ax = plt.subplots(figsize=((width/dpi)*extra_size, (height/dpi)*extra_size))
+        fig, ax = new_figure(figsize)
         placeholder_text = "Please define the input data and\nselect both X and Y axes."
         ax.text(0.5, 0.5, placeholder_text, ha='center', va='center', fontsize=10, color='grey')
         ax.set_axis_off()  # Hide axes for a cleaner look
-        
-        # Save the placeholder figure
-        fig_path = "static_figure.png"
-        plt.savefig(fig_path, dpi=dpi)
-        plt.close(fig)
-        return fig_path
+        image_bytes = figure_to_bytes(fig, dpi, fmt)
+        return (image_bytes, report) if return_report else image_bytes
     
     # Define color theme
-    if theme == 'dark':
-        plt.style.use('dark_background')
-    else:
-        plt.style.use('default')
-    if x_log:
-        min_positive_value = df[df[x_col] > 0][x_col].min()
-        df[x_col] = df[x_col].apply(lambda x: min_positive_value if x <= 0 else x)
-    if y_log:
-        min_positive_value = df[df[y_col] > 0][y_col].min()
-        df[y_col] = df[y_col].apply(lambda x: min_positive_value if x <= 0 else x)
-    if isinstance(point_color, dict) and 'hex' in point_color:
-        point_color = point_color['hex']
-    if isinstance(annotation_color, dict) and 'hex' in annotation_color:
-        annotation_color = annotation_color['hex']
-    if isinstance(annotation_font_color, dict) and 'hex' in annotation_font_color:
-        annotation_font_color = annotation_font_color['hex']
+    foreground = 'black' if theme == 'light' else 'white'
+    background = 'white' if theme == 'light' else 'black'
+    point_color = normalize_color(point_color)
+    annotation_color = normalize_color(annotation_color)
+    annotation_font_color = normalize_color(annotation_font_color)
     # Prepare figure
-    fig, ax = plt.subplots(figsize=((width/dpi)*extra_size, (height/dpi)*extra_size))  # Set square figure size
+    fig, ax = new_figure(figsize, facecolor=background)
     
-    sel_labels = get_annotate_labels(df, top_n, annotate_col, label_col,
-                                     annotate_revert, annotate_cutoff,
-                                     manual_genes)
+    with stage('annotate') as info:
+        sel_labels = get_annotate_labels(df, top_n, annotate_col, label_col,
+                                         annotate_revert, annotate_cutoff,
+                                         manual_genes, excluded_labels)
+        info['labels'] = len(sel_labels)
+    with stage('prepare', rows=len(df)):
+        data, highlighted = prepare_plot_data(df, x_col, y_col, x_log, y_log,
+                                              label_col, sel_labels)
 
-    if label_col and sel_labels:
+    with stage('static.plot', rows=len(data)):
         # Separate data into highlighted and non-highlighted
-        highlighted_df = df[df[label_col].isin(sel_labels)]
-        non_highlighted_df = df[~df[label_col].isin(sel_labels)]
-    
-        # Plot non-highlighted points
-        sns.scatterplot(x=x_col, y=y_col, data=non_highlighted_df, 
-                        ax=ax, s=point_size,
-                        color=point_color, 
-                        label='Data Points', legend=False, edgecolor=None)
-
-        # Plot highlighted points with a different color
-        sns.scatterplot(x=x_col, y=y_col, data=highlighted_df, 
-                        ax=ax, s=point_size,
-                        color=annotation_color, 
-                        label='Highlighted Points', legend=False)
-        # Apply log scaling to the data if specified
-        if x_log:
-            ax.set_xscale('log')
-        if y_log:
-            ax.set_yscale('log')
-        # Annotate highlighted points with repelling arrows
-        texts = []
-        for _, row in highlighted_df.iterrows():
-            label_text = str(row[label_col]) if row[label_col] else ''
-            label_text = label_text.replace('$', '')  # Remove any special characters
-            texts.append(ax.text(row[x_col], row[y_col], label_text, fontsize=annotation_font_size, color=annotation_font_color))
-        
-        adjust_text(texts, force_points=0.4, force_text=force_text, 
-                    expand_points=(1, 1), expand_text=(1, 1), 
-                    arrowprops=dict(arrowstyle='-', color='gray', lw=0.5))
-    
-    else:
+        non_highlighted_df = data[~highlighted] if highlighted.any() else data
+        if background_mode == 'auto':
+            background_mode = 'raster' if len(non_highlighted_df) > STATIC_RASTER_THRESHOLD else 'points'
         # Plot non-highlighted points
-        sns.scatterplot(x=x_col, y=y_col, data=df, ax=ax, s=point_size,
-                        color=point_color, label='Data Points', legend=False, edgecolor=None)
+        if background_mode == 'points':
+            sns.scatterplot(x=x_col, y=y_col, data=non_highlighted_df, 
+                            ax=ax, s=point_size,
+                            color=point_color, 
+                            label='Data Points', legend=False, edgecolor=None)
+        else:
+            draw_raster_background(ax, non_highlighted_df[x_col].to_numpy(dtype=float),
+                                   non_highlighted_df[y_col].to_numpy(dtype=float),
+                                   background_mode, point_size, point_color, x_log, y_log)
+
+        if highlighted.any():
+            # Plot highlighted points with a different color
+            sns.scatterplot(x=x_col, y=y_col, data=data[highlighted], 
+                            ax=ax, s=point_size,
+                            color=annotation_color, 
+                            label='Highlighted Points', legend=False)
         # Apply log scaling to the data if specified
         if x_log:
             ax.set_xscale('log')
         if y_log:
             ax.set_yscale('log')
     
-    # Reverse axes if specified
-    if x_revert:
-        ax.invert_xaxis()
-    if y_revert:
-        ax.invert_yaxis()
+        # Reverse axes if specified
+        if x_revert:
+            ax.invert_xaxis()
+        if y_revert:
+            ax.invert_yaxis()
     
-    # Customize plot aesthetics
-    ax.grid(False)
-    ax.set_facecolor('white' if theme == 'light' else 'black')
-    ax.spines['top'].set_visible(False)
-    ax.spines['bottom'].set_linewidth(0.5)
-    ax.spines['right'].set_visible(False)
-    ax.spines['left'].set_linewidth(0.5)
-    # Set axis labels and title with specific font sizes
-    ax.set_xlabel(x_col, fontsize=7)
-    ax.set_ylabel(y_col, fontsize=7)
-
-    # Set tick label size
-    ax.tick_params(axis='both', which='major', labelsize=5)  # Major ticks
-    # ax.tick_params(axis='both', which='minor', labelsize=)  # Minor ticks
-    ax.tick_params(axis='both', width=0.4) 
-    plt.xlabel(x_col)
-    plt.ylabel(y_col)
-    
-    # plt.legend()
-    # ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.tight_layout()
-
-    # Save the figure as a static image
-    fig_path = "static_figure.png"
-    plt.savefig(fig_path, dpi=dpi)
-    plt.close(fig)  # Close the figure after saving
+        # Customize plot aesthetics
+        ax.grid(False)
+        ax.set_facecolor(background)
+        ax.spines['top'].set_visible(False)
+        ax.spines['bottom'].set_linewidth(0.5)
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_linewidth(0.5)
+        ax.spines['bottom'].set_color(foreground)
+        ax.spines['left'].set_color(foreground)
+        # Set axis labels and title with specific font sizes
+        ax.set_xlabel(x_col, fontsize=7, color=foreground)
+        ax.set_ylabel(y_col, fontsize=7, color=foreground)
+
+        # Set tick label size
+        ax.tick_params(axis='both', which='major', labelsize=5)  # Major ticks
+        # ax.tick_params(axis='both', which='minor', labelsize=)  # Minor ticks
+        ax.tick_params(axis='both', width=0.4, colors=foreground)
     
-    return fig_path
+        # ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        fig.tight_layout()
+
+    if highlighted.any():
+        # Annotate highlighted points with repelling labels, placed once the
+        # axes have their final size; best ranked labels win when crowded
+        highlighted_df = data[highlighted]
+        texts = []
+        for x, y, label in zip(highlighted_df[x_col].to_numpy(),
+                               highlighted_df[y_col].to_numpy(),
+                               highlighted_df[label_col].to_numpy()):
+            label_text = str(label) if label else ''
+            label_text = label_text.replace('$', '')  # Remove any special characters
+            texts.append(ax.text(x, y, label_text, fontsize=annotation_font_size, color=annotation_font_color))
+        priorities = pd.Index(sel_labels).get_indexer(highlighted_df[label_col])
+        # Manually chosen labels are never dropped
+        required = highlighted_df[label_col].isin(parse_manual_genes(manual_genes)).to_numpy()
+        with stage('static.labels') as info:
+            report = place_labels(ax, texts, highlighted_df[x_col].to_numpy(),
+                                  highlighted_df[y_col].to_numpy(), priorities, required,
+                                  force_text=force_text, force_points=0.4,
+                                  max_iter=label_max_iter, time_budget=label_time_budget,
+                                  overflow=label_overflow)
+            info['labels'] = report.placed + report.overlapping
+
+    with stage('static.savefig') as info:
+        image_bytes = figure_to_bytes(fig, dpi, fmt)
+        info['bytes'] = len(image_bytes)
+    return (image_bytes, report) if return_report else image_bytes
+
+def draw_raster_background(ax, x, y, background_mode, point_size, point_color, x_log, y_log):
+    """Draw background points as one rasterized layer of ``ax``.
+
+    ``'raster'`` draws the points with a plain matplotlib scatter, ``'hexbin'``
+    as ``DENSITY_BINS`` hexagonal bins shaded like the interactive density
+    heatmap. Vector formats embed the layer as a single image at the dpi of
+    the figure.
+    """
+    if background_mode == 'raster':
+        ax.scatter(x, y, s=point_size, color=point_color, linewidths=0, rasterized=True)
+    elif background_mode == 'hexbin':
+        from matplotlib.colors import LinearSegmentedColormap, to_rgb
+        rgb = to_rgb(point_color)
+        cmap = LinearSegmentedColormap.from_list('density', [(*rgb, 0.25), (*rgb, 1)])
+        ax.hexbin(x, y, gridsize=DENSITY_BINS, bins='log', mincnt=1, cmap=cmap,
+                  xscale='log' if x_log else 'linear', yscale='log' if y_log else 'linear',
+                  linewidths=0, rasterized=True)
+    else:
+        raise ValueError(f"Unknown static background mode: {background_mode}")
+
+def import_seaborn():
+    """Import seaborn, with matplotlib's non-GUI backend selected first."""
+    import matplotlib
+    matplotlib.use('Agg')  # Use a non-GUI backend
+    import seaborn
+    return seaborn
+
+def new_figure(figsize, facecolor='white'):
+    """Create a figure and axes without touching pyplot's global state.
+
+    Each render gets its own Figure with an Agg canvas, so renders running
+    concurrently in threads or processes do not interfere.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize, facecolor=facecolor)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    return fig, ax
+
+def figure_to_bytes(fig, dpi, fmt='png'):
+    """Render ``fig`` in memory in the image format ``fmt`` and return the bytes."""
+    buffer = BytesIO()
+    fig.savefig(buffer, format=fmt, dpi=dpi, facecolor=fig.get_facecolor())
+    return buffer.getvalue()
+
+def normalize_color(color):
+    """Return the hex string of a ``daq.ColorPicker`` value."""
+    if isinstance(color, dict) and 'hex' in color:
+        return color['hex']
+    return color
+
+def clamp_non_positive(values):
+    """Replace values <= 0 by the smallest positive value, for log axes."""
+    values = np.asarray(values, dtype=float)
+    non_positive = values <= 0
+    if not non_positive.any():
+        return values
+    positive = values[values > 0]
+    min_positive_value = positive.min() if positive.size else np.nan
+    return np.where(non_positive, min_positive_value, values)
+
+def prepare_plot_data(df, x_col, y_col, x_log=False, y_log=False,
+                      label_col=None, sel_labels=()):
+    """Build the frame both renderers plot from, and the highlight mask.
+
+    Only the plotted columns are copied, so the (cached) input frame is never
+    modified. Returns ``(data, highlighted)`` where ``highlighted`` is a
+    boolean array marking the rows whose label is in ``sel_labels``.
+    """
+    columns = {x_col: clamp_non_positive(df[x_col]) if x_log else df[x_col],
+               y_col: clamp_non_positive(df[y_col]) if y_log else df[y_col]}
+    if label_col and label_col not in columns:
+        columns[label_col] = df[label_col]
+    data = pd.DataFrame(columns, index=df.index)
+    if label_col and len(sel_labels):
+        highlighted = df[label_col].isin(sel_labels).to_numpy()
+    else:
+        highlighted = np.zeros(len(df), dtype=bool)
+    return data, highlighted
+
+def parse_manual_genes(manual_genes):
+    """Split comma or space separated names into a sorted list without duplicates.
+
+    A list of names (e.g. labels resolved by a ``LabelIndex``) is only sorted.
+    """
+    if not manual_genes:
+        return []
+    if isinstance(manual_genes, str):
+        manual_genes = manual_genes.replace(',', ' ').split()
+    return sorted(set(manual_genes), key=str)
 
 def get_annotate_labels(df, top_n, annotate_col, label_col,
-                        annotate_revert, annotate_cutoff, manual_genes):
+                        annotate_revert, annotate_cutoff, manual_genes,
+                        excluded_labels=()):
+    """Return the labels to annotate, in order of priority without duplicates.
+
+    Labels picked by ranking come first (best ranked first), then labels
+    passing the cutoff, then the manually entered ones in alphabetical order.
+    ``excluded_labels`` are left out.
+    """
     # Store the labels after filtering by different criteria
     sel_labels = []
+    has_columns = annotate_col in df.columns and label_col in df.columns
 
     # Annotate based on the top N points in the annotate_col column
-    if top_n > 0 and annotate_col in df.columns and label_col in df.columns:
-        sorted_df = df.sort_values(by=annotate_col, ascending=not annotate_revert)
-        sel_labels += sorted_df[label_col].head(top_n).tolist()
+    if top_n and top_n > 0 and has_columns:
+        # Partial selection (argpartition) instead of sorting the whole column
+        values = df[annotate_col].to_numpy(dtype=float)
+        keys = -values if annotate_revert else values
+        top_n = min(int(top_n), len(keys))
+        top = np.argpartition(keys, top_n - 1)[:top_n]
+        top = top[np.argsort(keys[top], kind='stable')]
+        top = top[~np.isnan(keys[top])]  # NaNs are never ranked
+        sel_labels.append(df[label_col].iloc[top].to_numpy(dtype=object))
     
     # Annotate by the defined cutoff
-    if annotate_cutoff is not None and annotate_col in df.columns and label_col in df.columns:
-        if annotate_revert:
-            sel_labels += df[df[annotate_col] > annotate_cutoff][label_col].tolist()
-        else:
-            sel_labels += df[df[annotate_col] < annotate_cutoff][label_col].tolist()
+    if annotate_cutoff is not None and has_columns:
+        values = df[annotate_col].to_numpy()
+        passed = values > annotate_cutoff if annotate_revert else values < annotate_cutoff
+        sel_labels.append(df[label_col][passed].to_numpy(dtype=object))
     
     # Annotate manually entered genes
     if manual_genes:
-        sel_labels += [gene.strip() 
-                       for gene in manual_genes.replace(',', ' ').split()]
-        
-    sel_labels = list(set(sel_labels))  # Remove duplicates
-    return sel_labels
+        sel_labels.append(np.array(parse_manual_genes(manual_genes), dtype=object))
+    
+    if not sel_labels:
+        return []
+    # Remove duplicates, keeping the first (highest priority) occurrence
+    sel_labels = pd.unique(pd.Series(np.concatenate(sel_labels), dtype=object))
+    if len(excluded_labels):
+        sel_labels = sel_labels[~pd.Series(sel_labels, dtype=object).isin(excluded_labels).to_numpy()]
+    return sel_labels.tolist()
 
 # Using base64 encoding and decoding
-def b64_image(image_filename):
-    with open(image_filename, 'rb') as f:
-        image = f.read()
-    return 'data:image/png;base64,' + base64.b64encode(image).decode('utf-8')
\ No newline at end of file
+def b64_uri(data, mimetype):
+    return f'data:{mimetype};base64,' + base64.b64encode(data).decode('utf-8')
+
+
+def b64_png(png_bytes):
+    return b64_uri(png_bytes, 'image/png')
@@ -0,0 +1,20 @@
+"""WSGI entry point for production servers.
+
+Run several worker processes with ``gunicorn -c gunicorn.conf.py`` from the
+repository root, or point any WSGI server at ``wsgi:server`` with ``src`` on
+the Python path. Unless configured otherwise, datasets use the shared Arrow
+tier, so all workers memory-map one copy of each uploaded table.
+
+Log records of the app (cache stats, uploads, metrics) go to stderr tagged
+with the worker's pid, unless the server already configured logging.
+"""
+import logging
+import os
+
+os.environ.setdefault('ANNOFIG_DATASET_TIER', 'arrow')
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+
+from app import app  # noqa: E402
+
+server = app.server